@@ -1,39 +1,189 @@
-from Utils import create_dir_if_not_Exist, read_from_json, path_leaf, find_base_images, random_color, read_input_meta_table, write_output_schema, BOOLEAN_SCHEMA_TEMPLATE
-from PIL import Image
+from Utils import create_dir_if_not_Exist, read_from_json, path_leaf, parse_schema, write_schema, iter_work_units, StreamingTableWriter, StageMetrics, configure_logging, lazy_import
 import glob
-import random
-import pandas as pd
 import os
-import numpy as np
 import ntpath
 import getpass
 import json
-from joblib import Parallel, delayed
 from collections import OrderedDict
-from functools import reduce
+from itertools import chain
 import shutil
+import csv
+import heapq
+import tempfile
+import uuid as uuidlib
+import logging
+import time
 
+# imported on first use, see lazy_import
+pd = lazy_import("pandas")
 
-def find_images(inputDir, imageSampleCount):
+logger = logging.getLogger(__name__)
+
+
+# rows of the per-clip tables are identified by the clip and the generated image
+MERGE_KEY = ("ClipUuid", "NewImage")
+# tables of sharded tasks are named {uuid}.outputTable.shard001of004.metadata.csv
+TABLE_PATTERN = "*.outputTable*.metadata.csv"
+
+
+def find_clip_tables(inputDir):
+    '''
+        Finds the per-clip output tables, {uuid}.outputTable.metadata.csv or its gzip compressed version,
+        and the per-shard tables of sharded clips anywhere below {inputDir}. Returns them sorted by path so the merge order is stable.
+
+        Args:
+            inputDir: directory containing the ProcessClip results
+    '''
+    tables = []
+    for pattern in (TABLE_PATTERN, f'{TABLE_PATTERN}.gz'):
+        tables.extend(glob.glob(os.path.join(inputDir, '**', pattern), recursive=True))
+    return sorted(tables)
+
+
+def table_schema_file(tableFile):
+    '''
+        Returns the schema.md written next to {tableFile} by write_output_schema.
+    '''
+    if tableFile.endswith('.gz'):
+        tableFile = tableFile[:-len('.gz')]
+    return f'{tableFile[:-len(".csv")]}.schema.md'
+
+
+def read_table_columns(tableFile):
+    '''
+        Reads only the header of {tableFile} and returns its column names.
     '''
-        Function used by PrepareDataset.py to find all png images for processing within {baseDir}
+    return list(pd.read_csv(tableFile, nrows=0).columns)
+
+
+def union_schema(tableFiles):
+    '''
+        Unions the column definitions of the schema.md files of {tableFiles}, in first seen order.
+        A column defined with different types keeps the first type.
+
         Args:
-             baseDir: Directory that contains the png files.
-             imageSampleCount: number of images to sample out of the ones found. This does not provide unique images,
-             if the number is larger than the number of images found duplicates will get used.
+            tableFiles: per-clip tables, see find_clip_tables
     '''
-    images = find_base_images(inputDir)
+    columns = OrderedDict()
+    for tableFile in tableFiles:
+        schemaFile = table_schema_file(tableFile)
+        if not os.path.exists(schemaFile):
+            logger.warning(f'no schema found for {tableFile}')
+            continue
+        for name, columnType in parse_schema(schemaFile).items():
+            if name not in columns:
+                columns[name] = columnType
+            elif columns[name] != columnType:
+                logger.warning(f'column {name} is {columnType} in {schemaFile}, keeping {columns[name]}')
+    return columns
 
-    # sample the found images to imageSampleCount. This API can produce duplicates
-    images = random.choices(images, k=imageSampleCount)
-    return images
+
+def write_sorted_runs(tableFile, columns, runDir, runPrefix, chunkRows):
+    '''
+        Reads {tableFile} {chunkRows} rows at a time and writes every chunk, sorted on MERGE_KEY and
+        aligned to the union of {columns}, as a run file to {runDir}. Returns the run files in table order.
+        Values are kept as the strings in the table so they are written back unchanged.
+
+        Args:
+            tableFile: per-clip table to read
+            columns: columns of the merged table, missing columns are left empty
+            runDir: directory for the run files
+            runPrefix: prefix of the run file names, unique per table
+            chunkRows: number of rows read and sorted at a time
+    '''
+    runs = []
+    for chunk in pd.read_csv(tableFile, dtype=str, keep_default_na=False, chunksize=chunkRows):
+        chunk = chunk.reindex(columns=columns, fill_value='')
+        # stable sort so duplicates within a table keep their order and the first one is kept
+        chunk = chunk.sort_values(list(MERGE_KEY), kind='stable')
+        runPath = os.path.join(runDir, f'{runPrefix}.{len(runs):05d}.csv')
+        chunk.to_csv(runPath, index=False)
+        runs.append(runPath)
+    return runs
+
+
+def read_run(runPath):
+    '''
+        Yields the rows of a run file written by write_sorted_runs, without the header.
+    '''
+    with open(runPath, 'r', newline='', encoding='utf8') as openFile:
+        reader = csv.reader(openFile)
+        next(reader)
+        yield from reader
+
+
+def merge_runs(runs, keyIndices):
+    '''
+        Merges the sorted {runs} into one sorted stream of rows, dropping every row whose key was
+        already seen. On equal keys the row of the earlier run is kept.
+        Only one row per run is held in memory.
+
+        Args:
+            runs: run files, each sorted on the key
+            keyIndices: positions of the key columns in a row
+    '''
+    def row_key(row):
+        return tuple(row[i] for i in keyIndices)
+
+    lastKey = None
+    for row in heapq.merge(*(read_run(run) for run in runs), key=row_key):
+        key = row_key(row)
+        if key == lastKey:
+            continue
+        lastKey = key
+        yield row
+
+
+def write_run(rows, columns, runPath):
+    '''
+        Writes the {rows} as a run file to {runPath}.
+    '''
+    with open(runPath, 'w', newline='', encoding='utf8') as openFile:
+        writer = csv.writer(openFile, lineterminator='\n')
+        writer.writerow(columns)
+        writer.writerows(rows)
+    return runPath
+
+
+def reduce_runs(runs, columns, keyIndices, runDir, fanIn):
+    '''
+        Merges {runs} in groups of at most {fanIn} into intermediate runs until at most {fanIn} are left,
+        which bounds the number of files open at once in the final merge.
+
+        Args:
+            runs: sorted run files
+            columns: columns of the runs
+            keyIndices: positions of the key columns in a row
+            runDir: directory for the intermediate runs
+            fanIn: maximum number of runs merged at once
+    '''
+    fanIn = max(2, fanIn)
+    mergePass = 0
+    while len(runs) > fanIn:
+        mergedRuns = []
+        for i in range(0, len(runs), fanIn):
+            group = runs[i:i + fanIn]
+            runPath = os.path.join(runDir, f'merge{mergePass}.{len(mergedRuns):05d}.csv')
+            mergedRuns.append(write_run(merge_runs(group, keyIndices), columns, runPath))
+            for run in group:
+                os.remove(run)
+        logger.info(f'merge pass {mergePass}: {len(runs)} runs into {len(mergedRuns)}')
+        runs = mergedRuns
+        mergePass += 1
+    return runs
 
 
 def StartAggregate(inputData):
-    ''' Defines method that will be run in ProcessClip stage on each
-       individual clip.
+    ''' Defines method that will be run in the Aggregate stage on the results
+       of all ProcessClip tasks.
        Method signature defined by AP.Data.
 
+       Merges the per-clip {uuid}.outputTable.metadata.csv tables found in dataDir into one table,
+       de-duplicated on (ClipUuid, NewImage), next to the union of their schema.md definitions.
+       The tables are read in chunks of MergeChunkRows rows which are sorted and written as run files,
+       the runs are then merged MergeFanIn at a time. Memory is bounded by the chunk size, not by
+       the number of clips.
+
     Args:
         inputData:
             dataDir: Data which contains the dataset staged.
@@ -50,7 +200,23 @@ def StartAggregate(inputData):
 
     settings = read_from_json(inputData.scriptConfig)
 
-    # location of all images and associated metadata
+    # see StageMetrics for the metrics levels, they are written to {uuid}.stage_metrics.json
+    configure_logging(settings.get("LogLevel", "INFO"))
+    metrics = StageMetrics("aggregate", settings.get("MetricsLevel", "INFO"))
+    stageStart = time.perf_counter()
+
+    # rows read and sorted at a time per table, and number of runs merged at once
+    chunkRows = int(settings.get("MergeChunkRows", 50000))
+    fanIn = int(settings.get("MergeFanIn", 64))
+    outputChunkRows = int(settings.get("OutputChunkRows", 1000))
+    # gzip writes the merged table as .metadata.csv.gz, the training script reads it, the AP handler needs plain csv
+    outputCompression = settings.get("OutputCompression") or None
+
+    # the tables are read on threads, pandas releases the GIL while parsing
+    executorBackend = settings.get("ExecutorBackend", "threads")
+    workerCount = int(settings.get("WorkerCount", 0)) or None
+
+    # location of the per-clip results
     inputDir = inputData.dataDir
 
     # AP will aggregate and upload metadata files within AP_Metadata in the result folder
@@ -58,40 +224,51 @@ def StartAggregate(inputData):
     resultMetadataFolder = f'{inputData.resultDir}\\AP_Metadata'
     create_dir_if_not_Exist(resultMetadataFolder)
 
-    # During ingestion an aptable was generated and saved. AP will save a CSV version (with associated schema) automatically
-    # this file contains all metadata for the images
-    tableFile, uuid, schemaFile = read_input_meta_table(
-        inputDir)
-
-    # any new column definitions go here.
-    columnDefinitions = []
-    write_output_schema(resultMetadataFolder, uuid,
-                        schemaFile, columnDefinitions)
-
-    # read the table file that contains metadata for each overlay we will work with
-    df = pd.read_csv(tableFile, sep=',', header='infer')
+    tableFiles = find_clip_tables(inputDir)
+    if not tableFiles:
+        raise FileNotFoundError(f"Did not find any {TABLE_PATTERN} in {inputDir}")
+    logger.info(f'merging {len(tableFiles)} tables')
+    metrics.count("tables", len(tableFiles))
 
-    # grab the current columns and create an empty data frame
-    # new data frame will contain the propagated metadata and new information about
-    # the created image.
-    cols = df.columns
-    emptyDf = pd.DataFrame(columns=cols)
+    # the merged table has the union of the columns, in first seen order
+    columns = list(OrderedDict.fromkeys(chain.from_iterable(read_table_columns(t) for t in tableFiles)))
+    missingKeys = [k for k in MERGE_KEY if k not in columns]
+    if missingKeys:
+        raise ValueError(f"Tables are missing the merge key columns {missingKeys}")
+    keyIndices = [columns.index(k) for k in MERGE_KEY]
 
+    # name the result after the merged tables so rerunning on the same input overwrites it
+    uuid = str(uuidlib.uuid5(uuidlib.NAMESPACE_URL, ",".join(path_leaf(t) for t in tableFiles)))
 
-    # generate the images in parallel
-    #results = Aggregation()
-    results = []
+    schemaColumns = union_schema(tableFiles)
+    write_schema(os.path.join(resultMetadataFolder, f'{uuid}.outputTable.metadata.schema.md'), schemaColumns)
 
-    # flatten the results and iterate through them to insert them into the empty data frame
-    # here we will decide if the images are part of a data Training or Testing data
-    for  row in reduce(list.__add__, results):
-        #add any additional metadata 
+    runDir = tempfile.mkdtemp(prefix='aggregate_runs', dir=inputData.resultDir)
+    try:
+        # sort the chunks of every table into runs in parallel
+        workUnits = [(tableFile, columns, runDir, f'table{i:05d}', chunkRows) for i, tableFile in enumerate(tableFiles)]
+        with metrics.timer("sort_runs"):
+            runs = list(chain.from_iterable(iter_work_units(write_sorted_runs, workUnits, executorBackend, workerCount)))
+        metrics.count("runs", len(runs))
+        with metrics.timer("reduce_runs"):
+            runs = reduce_runs(runs, columns, keyIndices, runDir, fanIn)
 
-        # add row, and append new columns to it
-        emptyDf = emptyDf.append(row, ignore_index=True, sort=False)
+        # name as .metadata.csv inside ap_metadata folder to ensure it gets picked up by the handler
+        # the schema file next to it will define the types for the data in this table.
+        mergeStart = time.perf_counter()
+        with StreamingTableWriter(f'{resultMetadataFolder}\\{uuid}.outputTable.metadata.csv', outputCompression) as writer:
+            rows = []
+            for row in merge_runs(runs, keyIndices):
+                rows.append(row)
+                if len(rows) >= outputChunkRows:
+                    writer.write(pd.DataFrame(rows, columns=columns))
+                    rows = []
+            writer.write(pd.DataFrame(rows, columns=columns))
+        metrics.add_time("merge", time.perf_counter() - mergeStart)
+        metrics.count("rows_written", writer.rowsWritten)
+        logger.info(f'wrote {writer.rowsWritten} rows to {writer.path}')
+    finally:
+        shutil.rmtree(runDir, ignore_errors=True)
 
-    # name as .metadata.csv inside ap_metadata folder to ensure it gets picked up by the handler
-    # the schema file next to it will define the types for the data in this table.
-    # keep the UUID in the table to avoid collisions accross tasks. ap handler will merge all of them in the next step into one
-    # and propegate the schema file.
-    emptyDf.to_csv(f'{resultMetadataFolder}\\{uuid}.outputTable.metadata.csv')
+    metrics.add_time("total", time.perf_counter() - stageStart)
+    metrics.write(os.path.join(resultMetadataFolder, f'{uuid}.stage_metrics.json'))
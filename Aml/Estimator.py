@@ -1,6 +1,4 @@
 import json
-from azureml.core.runconfig import ContainerRegistry
-from azureml.train.dnn import PyTorch
 from Utils import read_from_json
 
 
@@ -22,6 +20,10 @@ def GetEstimator(environmentInfo, inpData):
             sourceDir: directory with experiment code
     '''
 
+    # azureml is only needed to submit the run, importing it here keeps the module importable without it
+    from azureml.core.runconfig import ContainerRegistry
+    from azureml.train.dnn import PyTorch
+
     conda_packages = None
     pip_packages = None
 
@@ -33,13 +35,27 @@ def GetEstimator(environmentInfo, inpData):
 
     ds = environmentInfo.datastore
 
+    estimatorConfig = read_from_json(inpData.scriptConfig)
+    trainingConfig = read_from_json(inpData.training_config)
+
+    # node_count nodes each running process_count_per_node processes, more than one process in total
+    # runs the evaluation with MPI, see DistributedBackend in TrainingConfig.json
+    nodeCount = int(estimatorConfig.get("node_count", 1))
+    processCountPerNode = int(estimatorConfig.get("process_count_per_node", 1))
+    distributedTraining = None
+    if nodeCount * processCountPerNode > 1:
+        from azureml.core.runconfig import MpiConfiguration
+        distributedTraining = MpiConfiguration()
+        distributedTraining.process_count_per_node = processCountPerNode
+        trainingConfig["DistributedBackend"] = "mpi"
+        print(f'running on {nodeCount} nodes with {processCountPerNode} processes per node')
+
     script_params = {
         "--data_dir": inpData.dataDir,
-        "--training_config": json.dumps(read_from_json(inpData.training_config))
+        "--training_config": json.dumps(trainingConfig)
     }
 
     print(f'using script_params {script_params}')
-    estimatorConfig = read_from_json(inpData.scriptConfig)
 
     conda_packages = estimatorConfig["conda_packages"]
     pip_packages = estimatorConfig["pip_packages"]
@@ -57,6 +73,8 @@ def GetEstimator(environmentInfo, inpData):
         source_directory=inpData.sourceDir,
         script_params=script_params,
         compute_target=environmentInfo.compute,
+        node_count=nodeCount,
+        distributed_training=distributedTraining,
         entry_script='train_model_pytorch.py',
         use_gpu=True,
         source_directory_data_store=environmentInfo.datastore,
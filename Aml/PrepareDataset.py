@@ -1,32 +1,429 @@
-from Utils import create_dir_if_not_Exist, read_from_json, path_leaf, find_base_images, random_color, read_input_meta_table, write_output_schema, BOOLEAN_SCHEMA_TEMPLATE
-from PIL import Image
+from Utils import create_dir_if_not_Exist, read_from_json, path_leaf, find_base_images, read_input_meta_table, load_meta_table, write_output_schema, chunk_list_by_weight, get_directory_index, iter_work_units, StagedPipeline, build_name_index, ResultTableBuilder, StreamingTableWriter, ImageShardWriter, StageMetrics, configure_logging, file_hash, content_hash, lazy_import, BOOLEAN_SCHEMA_TEMPLATE
 import glob
 import random
-import pandas as pd
 import os
-import numpy as np
 import ntpath
 import getpass
 import json
-from joblib import Parallel, delayed
 from collections import OrderedDict
-from functools import reduce
 import shutil
+import io
+import logging
+import time
 
+# imported on first use, see lazy_import
+Image = lazy_import("PIL.Image")
+pd = lazy_import("pandas")
+np = lazy_import("numpy")
 
-def find_images(inputDir, imageSampleCount):
+logger = logging.getLogger(__name__)
+
+# image mode we will be working with
+IMAGE_MODE = "RGB"
+
+# where the overlay is pasted onto the generated background
+OVERLAY_POSITION = (0, 0)
+
+# split names recorded in the prepare manifest
+TRAIN_SPLIT = "train"
+VAL_SPLIT = "val"
+TEST_SPLIT = "test"
+
+# independent random streams drawn from the seed of the run
+PLAN_SAMPLE_STREAM = 0
+PLAN_VARIANT_STREAM = 1
+
+
+def plan_image_jobs(images, imageSampleCount, seed):
+    '''
+        Samples {imageSampleCount} picks out of {images} with replacement and groups them into one job per unique file.
+        Sampling picks the same png many times, a job carries how often it was picked so the file is decoded once
+        and all of its variants are produced together.
+        The images are sorted first, the plan only depends on the {seed} and the set of files found.
+        Args:
+             images: list of image paths, see find_base_images
+             imageSampleCount: number of picks, larger than the number of images means duplicates get used
+             seed: random seed of the run
+        Returns:
+             list of (image, multiplicity) tuples in image path order
+    '''
+    images = sorted(images)
+    if not images:
+        return []
+
+    rng = np.random.default_rng([seed, PLAN_SAMPLE_STREAM])
+    counts = np.bincount(rng.integers(0, len(images), imageSampleCount), minlength=len(images))
+    return [(images[i], int(counts[i])) for i in np.flatnonzero(counts)]
+
+
+def plan_job_variants(plan, backgroundPerImage, colorMin, colorMax, testThreshhold, valThreshhold, seed):
+    '''
+        Draws the background colors, output names and split of every job of {plan} in one vectorized pass.
+        Colors are distinct per job, otherwise {filename}_{color}.png of a duplicate pick would overwrite
+        an earlier variant. The split is drawn once per source image so all of its variants are in the same split:
+        test with probability {testThreshhold}, otherwise training, and training images are used for validation
+        with probability {valThreshhold}.
+        Only depends on the {plan} and the {seed}, a rerun with the plan of the manifest gets the same variants.
+        Args:
+             plan: list of (image, multiplicity) tuples, see plan_image_jobs
+             backgroundPerImage: number of backgrounds to generate per pick
+             colorMin: Min value for RGB of the background
+             colorMax: Max value for RGB of the background
+             seed: random seed of the run
+        Returns:
+             dict of image to (variants, split), variants holds a (color, newName) tuple per image to generate
+    '''
+    if not plan:
+        return {}
+
+    rng = np.random.default_rng([seed, PLAN_VARIANT_STREAM])
+    counts = np.array([multiplicity for _, multiplicity in plan], dtype=np.int64) * backgroundPerImage
+    available = (colorMax - colorMin + 1) ** 3
+    if counts.max() > available:
+        raise ValueError(f"Cannot draw {counts.max()} distinct colors from the {available} in range ({colorMin}, {colorMax})")
+
+    # draw all colors at once, then redraw the ones repeated within their job until every color of a job is distinct
+    jobIds = np.repeat(np.arange(len(plan), dtype=np.int64), counts)
+    colors = rng.integers(colorMin, colorMax + 1, size=(len(jobIds), 3), dtype=np.int64)
+    while True:
+        keys = (jobIds << 24) | (colors[:, 0] << 16) | (colors[:, 1] << 8) | colors[:, 2]
+        _, firstPositions = np.unique(keys, return_index=True)
+        repeated = np.setdiff1d(np.arange(len(keys)), firstPositions)
+        if len(repeated) == 0:
+            break
+        colors[repeated] = rng.integers(colorMin, colorMax + 1, size=(len(repeated), 3), dtype=np.int64)
+
+    # one draw per source image, both draws are always made so the split does not change the colors
+    testDraws = rng.random(len(plan))
+    valDraws = rng.random(len(plan))
+    splits = np.where(testDraws <= testThreshhold, TEST_SPLIT,
+                      np.where(valDraws < valThreshhold, VAL_SPLIT, TRAIN_SPLIT))
+
+    colorTuples = list(map(tuple, colors.tolist()))
+    offsets = np.concatenate(([0], np.cumsum(counts))).tolist()
+    variants = {}
+    for j, (image, _) in enumerate(plan):
+        filename = os.path.splitext(path_leaf(image))[0]
+        variants[image] = ([(color, f"{filename}_{color}.png") for color in colorTuples[offsets[j]:offsets[j + 1]]],
+                           str(splits[j]))
+    return variants
+
+
+def shard_plan(plan, shardIndex, shardCount):
+    '''
+        Returns the slice of {plan} processed by shard {shardIndex} of {shardCount}, a contiguous range of about
+        len(plan) / shardCount jobs. Every job is in exactly one shard and the shards in index order cover the plan in order.
+        Args:
+             plan: list of (image, multiplicity) tuples, see plan_image_jobs
+             shardIndex: index of the shard, from 0
+             shardCount: number of shards the plan is split into
+    '''
+    return plan[len(plan) * shardIndex // shardCount:len(plan) * (shardIndex + 1) // shardCount]
+
+
+def decode_overlay(image):
+    '''
+        Decodes the overlay png {image} a single time into an RGBA uint8 array of shape (H, W, 4).
+        Overlays without an alpha channel are treated as fully opaque.
+        Args:
+             image: path or file object of the overlay png to decode
+    '''
+    with Image.open(image) as overlay:
+        return np.asarray(overlay.convert("RGBA"))
+
+
+def composite_backgrounds(overlay, colors):
+    '''
+        Alpha blends {overlay} over a solid background of every color in {colors} in one batched pass.
+        Produces the same pixels as pasting the overlay with its own alpha mask onto Image.new(color).
+        Args:
+             overlay: RGBA uint8 array of shape (H, W, 4), see decode_overlay
+             colors: sequence of N (R, G, B) tuples to use as backgrounds
+        Returns:
+             uint8 array of shape (N, H, W, 3) with one composited image per color
+    '''
+    alpha = overlay[..., 3:].astype(np.uint16)
+    foreground = overlay[..., :3].astype(np.uint16) * alpha
+    backgrounds = np.asarray(colors, dtype=np.uint16).reshape(-1, 1, 1, 3)
+
+    # fg * a + bg * (255 - a), rounded to nearest when dividing by 255 (max value fits in uint16)
+    blended = foreground + backgrounds * (255 - alpha) + 127
+    blended //= 255
+    return blended.astype(np.uint8)
+
+
+def resolve_image_jobs(jobs, nameIndex):
+    '''
+        Resolves the metadata row of every job planned by plan_image_jobs through {nameIndex}.
+        Images without a row in the aptable are reported and dropped instead of producing images
+        that have no metadata.
+        Args:
+             jobs: list of (image, multiplicity) tuples, see plan_image_jobs
+             nameIndex: name to row position index, see build_name_index
+        Returns:
+             list of (image, multiplicity, rowPosition) tuples
+    '''
+    resolvedJobs = []
+    missing = []
+    for image, multiplicity in jobs:
+        filename = os.path.splitext(path_leaf(image))[0]
+        rowPosition = nameIndex.get(filename)
+        if rowPosition is None:
+            missing.append(filename)
+            continue
+        resolvedJobs.append((image, multiplicity, rowPosition))
+
+    if missing:
+        logger.warning(f"Skipping {len(missing)} images without a metadata row: {missing[:10]}")
+    return resolvedJobs
+
+
+class PrepareManifest:
+    '''
+        Append only record of the images generated by a Prepare task, kept next to AP_Metadata so a retried task
+        can skip the work that is already done.
+        The first line holds the settings, the sampling plan and the random seed of the run. Both are reused on a
+        rerun so regenerated images get the same colors and splits and the output table matches a clean run.
+        Each following line records one completed job:
+        {"image": ..., "hash": ..., "rowPosition": ..., "variants": [{"color": [r, g, b], "output": ..., "split": ...}]}
+        Images packed into tar shards record the shard as output and the image name as member.
+
+        Args:
+             path: manifest file
+             settings: settings the images depend on, a manifest written with other settings is ignored
     '''
-        Function used by PrepareDataset.py to find all png images for processing within {baseDir}
+
+    def __init__(self, path, settings):
+        self.path = path
+        self.settings = json.loads(json.dumps(settings))
+        self.plan = None
+        self.seed = None
+        self.records = OrderedDict()
+        self._file = None
+
+    def load(self):
+        '''
+            Loads the plan and the completed jobs of a previous run with the same settings.
+            Returns True when a usable manifest was found.
+        '''
+        if not os.path.exists(self.path):
+            return False
+
+        with open(self.path, encoding='utf8') as openFile:
+            lines = openFile.read().splitlines()
+
+        try:
+            header = json.loads(lines[0]) if lines else {}
+        except ValueError:
+            return False
+        if header.get("settings") != self.settings:
+            logger.warning(f"Ignoring manifest {self.path} written with different settings")
+            return False
+
+        self.plan = [tuple(job) for job in header["plan"]]
+        self.seed = header["seed"]
+        for line in lines[1:]:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # the last line is cut off when the task was killed while writing it
+                break
+            self.records[record["image"]] = record
+        return True
+
+    def open(self, plan, seed):
+        '''
+            Starts writing the manifest for {plan}. The file is rewritten with the records that are still
+            valid so a partially written last line of an earlier run is dropped.
+            Args:
+                 plan: list of (image, multiplicity) tuples, see plan_image_jobs
+                 seed: random seed of the run, see plan_job_variants
+        '''
+        self.plan = plan
+        self.seed = seed
+        self._file = open(self.path, 'w', encoding='utf8')
+        self._write({"settings": self.settings, "plan": plan, "seed": seed})
+        for record in self.records.values():
+            self._write(record)
+
+    def is_complete(self, image, sourceHash):
+        '''
+            Returns True if {image} with content {sourceHash} was already processed and all of its outputs exist.
+        '''
+        record = self.records.get(image)
+        return record is not None and record["hash"] == sourceHash \
+            and all(os.path.exists(variant["output"]) for variant in record["variants"])
+
+    def discard(self, image):
+        '''
+            Removes the record of {image} along with any output files of it that are left on disk.
+            Shards are shared by many images and are kept.
+        '''
+        record = self.records.pop(image, None)
+        if record is not None:
+            for variant in record["variants"]:
+                if "member" not in variant and os.path.exists(variant["output"]):
+                    os.remove(variant["output"])
+
+    def add(self, record):
+        '''
+            Records a completed job, the record is flushed to disk right away.
+        '''
+        self.records[record["image"]] = record
+        self._write(record)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+    def _write(self, entry):
+        self._file.write(json.dumps(entry) + "\n")
+        self._file.flush()
+
+
+def decode_job(job, metrics):
+    '''
+        Decode step of generate_new_image: hashes the overlay of {job} and decodes it.
+        Jobs hold one unique overlay each, so every overlay is decoded once per task.
+        Args:
+             job: (image, rowPosition, variants, sourceHash) tuple, sourceHash is None when it was not computed yet
+        Returns:
+             (job, sourceHash, overlay) tuple
+    '''
+    image, sourceHash = job[0], job[3]
+    with metrics.latency("decode"):
+        # the png is read once, the hash and the decode work on the same bytes
+        with open(image, 'rb') as openFile:
+            data = openFile.read()
+        if sourceHash is None:
+            sourceHash = content_hash(data)
+        overlay = decode_overlay(io.BytesIO(data))
+    return job, sourceHash, overlay
+
+
+def composite_job(decoded, metrics):
+    '''
+        Composite step of generate_new_image: blends the overlay over every background color of the job in one pass.
         Args:
-             baseDir: Directory that contains the png files.
-             imageSampleCount: number of images to sample out of the ones found. This does not provide unique images,
-             if the number is larger than the number of images found duplicates will get used.
+             decoded: (job, sourceHash, overlay) tuple, see decode_job
+        Returns:
+             (job, sourceHash, composites) tuple
     '''
-    images = find_base_images(inputDir)
+    job, sourceHash, overlay = decoded
+    with metrics.latency("composite"):
+        composites = composite_backgrounds(overlay, [color for color, _ in job[2]])
+    return job, sourceHash, composites
 
-    # sample the found images to imageSampleCount. This API can produce duplicates
-    images = random.choices(images, k=imageSampleCount)
-    return images
+
+def encode_job(composited, metrics):
+    '''
+        Encode step of generate_new_image: encodes every composite of the job as a png.
+        Args:
+             composited: (job, sourceHash, composites) tuple, see composite_job
+        Returns:
+             (job, sourceHash, encoded) tuple, encoded holds a BytesIO with the png of every variant
+    '''
+    job, sourceHash, composites = composited
+    encoded = []
+    for composite in composites:
+        with metrics.latency("encode"):
+            data = io.BytesIO()
+            Image.fromarray(composite).convert(IMAGE_MODE).save(data, "PNG")
+        encoded.append(data)
+    return job, sourceHash, encoded
+
+
+def write_job(encoded, resultPath, outputFormat, metrics):
+    '''
+        Write step of generate_new_image: saves the encoded images of the job to {resultPath}.
+        With the tar output format the encoded images are returned instead, the caller packs them into shards.
+        Args:
+             encoded: (job, sourceHash, encoded) tuple, see encode_job
+        Returns:
+             the result of generate_new_image
+    '''
+    (image, rowPosition, variants, _), sourceHash, encodedImages = encoded
+    filename = os.path.splitext(path_leaf(image))[0]
+
+    # list of new image records, only plain values are returned, keeping results cheap to send back from worker processes
+    newImages = []
+    for (color, newName), data in zip(variants, encodedImages):
+        if outputFormat == "tar":
+            newImages.append((color, newName, data.getvalue()))
+            continue
+
+        newFile = f"{resultPath}\\{newName}"
+        logger.debug(f"FileName: {filename}, newFile: {newFile}, color: {color}")
+
+        # save the new file
+        with metrics.latency("write"):
+            with open(newFile, 'wb') as openFile:
+                openFile.write(data.getbuffer())
+        newImages.append((color, newFile, None))
+
+    metrics.count("images_generated", len(newImages))
+    return image, rowPosition, sourceHash, newImages
+
+
+def generate_new_image(image, rowPosition, variants, resultPath, outputFormat="files", metrics=None, sourceHash=None):
+    '''
+        Generates the planned {variants} of the overlay {image}, one per background color,
+        and saves them to {resultPath}. With the tar output format the encoded
+        images are returned instead, the caller packs them into shards.
+        Runs the decode, composite, encode and write steps one after the other, the pipeline backend
+        runs them as the stages of a StagedPipeline instead, see prepare_pipeline.
+        Args:
+             image: path of the overlay png
+             rowPosition: position of the metadata row of the image in the aptable, returned with every record
+             variants: list of (color, newName) tuples, see plan_job_variants
+             resultPath: directory to save the new images in
+             outputFormat: files to save every image as a png file, tar to return the png bytes
+             metrics: StageMetrics the decode, composite, encode and write latencies are recorded in
+             sourceHash: sha1 of the overlay when the caller already computed it, otherwise computed while decoding
+        Returns:
+             (image, rowPosition, sourceHash, newImages) tuple, newImages holds a (color, newFile, data) tuple per generated image.
+             data is None for the files output format, for tar newFile is the image name and data the png bytes.
+    '''
+    metrics = metrics or StageMetrics("prepare", "OFF")
+
+    # decode the overlay once and blend it over every background color in one pass.
+    decoded = decode_job((image, rowPosition, variants, sourceHash), metrics)
+    return write_job(encode_job(composite_job(decoded, metrics), metrics), resultPath, outputFormat, metrics)
+
+
+def prepare_pipeline(resultPath, outputFormat, metrics, workerCounts, queueSize):
+    '''
+        Builds the StagedPipeline running the decode, composite, encode and write steps of generate_new_image
+        as stages, each on its own threads, so decoding, blending, png encoding and disk writes overlap.
+        Args:
+             resultPath: directory to save the new images in
+             outputFormat: files or tar, see write_job
+             metrics: StageMetrics the latencies of the steps are recorded in
+             workerCounts: number of threads of the decode, composite, encode and write stages
+             queueSize: capacity of the queue in front of every stage
+    '''
+    decodeWorkers, compositeWorkers, encodeWorkers, writeWorkers = workerCounts
+    return StagedPipeline([("decode", lambda job: decode_job(job, metrics), decodeWorkers),
+                           ("composite", lambda decoded: composite_job(decoded, metrics), compositeWorkers),
+                           ("encode", lambda composited: encode_job(composited, metrics), encodeWorkers),
+                           ("write", lambda encoded: write_job(encoded, resultPath, outputFormat, metrics), writeWorkers)],
+                          queueSize)
+
+
+def generate_new_images(jobs, resultPath, outputFormat="files", metricsLevel="OFF"):
+    '''
+        Work unit used by StartPrepare, runs generate_new_image for a chunk of {jobs}.
+        Args:
+             jobs: list of (image, rowPosition, variants, sourceHash) tuples, see decode_job
+             metricsLevel: level of the StageMetrics recorded by the work unit
+        Returns:
+             list with the result of generate_new_image for each job in the chunk and the snapshot of the metrics
+             of the work unit, which the caller merges as the unit may have run in another process
+    '''
+    metrics = StageMetrics("prepare", metricsLevel)
+    results = [generate_new_image(image, rowPosition, variants, resultPath, outputFormat, metrics, sourceHash)
+               for image, rowPosition, variants, sourceHash in jobs]
+    return results, metrics.snapshot()
 
 
 def StartPrepare(inputData):
@@ -50,6 +447,13 @@ def StartPrepare(inputData):
 
     settings = read_from_json(inputData.scriptConfig)
 
+    # LogLevel DEBUG logs every generated image. MetricsLevel INFO records stage timers and counters,
+    # DEBUG adds per-image latency histograms and OFF disables them, they are written to {uuid}.stage_metrics.json
+    configure_logging(settings.get("LogLevel", "INFO"))
+    metricsLevel = settings.get("MetricsLevel", "INFO")
+    metrics = StageMetrics("prepare", metricsLevel)
+    stageStart = time.perf_counter()
+
     # range used when determining background color.
     # This could be split further to control RGB bounds separately
     colorMin = int(settings["ColorRangeMin"])
@@ -69,19 +473,64 @@ def StartPrepare(inputData):
     # what percentage of images used for training to use for validation
     valThreshhold = float(settings["ValThreshhold"])
 
+    # how the images are generated: threads, processes, serial or pipeline.
+    # png encode/decode holds the GIL for a good part of the work, processes scale better on large nodes.
+    # pipeline runs decode, composite, encode and write as stages with their own thread counts linked by queues
+    # of PipelineQueueSize jobs, the utilization and queue depth of every stage are written to the stage metrics
+    executorBackend = settings.get("ExecutorBackend", "threads")
+    workerCount = int(settings.get("WorkerCount", os.cpu_count() or 1))
+    pipelineWorkers = (int(settings.get("DecodeWorkers", 2)), int(settings.get("CompositeWorkers", 2)),
+                       int(settings.get("EncodeWorkers", workerCount)), int(settings.get("WriteWorkers", 2)))
+    pipelineQueueSize = int(settings.get("PipelineQueueSize", 16))
+
+    # number of unique images handled by one work unit, amortizes the per task overhead of the executor
+    chunkSize = int(settings.get("ChunkSize", 8))
+
+    # how aptable rows sharing a name are handled: first uses the first row, error fails the task
+    duplicateNamePolicy = settings.get("DuplicateNamePolicy", "first")
+
+    # the output table is written in chunks of this many rows as images complete, optionally gzip compressed.
+    # Aggregate and the training script read the resulting .metadata.csv.gz, the AP handler only reads plain csv
+    # tables, leave OutputCompression empty when AP uploads the table
+    outputChunkRows = int(settings.get("OutputChunkRows", 10000))
+    outputCompression = settings.get("OutputCompression") or None
+
+    # files writes one png per generated image, tar packs them into shards of about ShardSizeMB with an index per shard
+    outputFormat = settings.get("OutputFormat", "files")
+    shardBytes = int(settings.get("ShardSizeMB", 256)) * 1024 * 1024
+    if outputFormat not in ("files", "tar"):
+        raise ValueError(f"Unknown output format {outputFormat}, expected files or tar")
+
+    # a heavy clip can be split across several tasks, each task processes its shard of the plan and writes
+    # its own output table. set through the inputData fields or the config, all shards need the same Seed.
+    # an inputData field of 0 is a valid shard index and takes precedence over the config.
+    shardIndex = getattr(inputData, "shardIndex", None)
+    if shardIndex is None:
+        shardIndex = settings.get("ShardIndex", 0)
+    shardCount = getattr(inputData, "shardCount", None)
+    if shardCount is None:
+        shardCount = settings.get("ShardCount", 1)
+    shardIndex, shardCount = int(shardIndex), int(shardCount)
+    if shardCount < 1 or not 0 <= shardIndex < shardCount:
+        raise ValueError(f"Invalid shard {shardIndex} of {shardCount}")
+    if shardCount > 1 and not settings.get("Seed"):
+        raise ValueError("Seed is required when the clip is sharded, every shard has to draw the same plan")
+    shardSuffix = f'.shard{shardIndex:03d}of{shardCount:03d}' if shardCount > 1 else ''
+    tableName = f'outputTable{shardSuffix}'
+
     # location of all images and associated metadata
     inputDir = inputData.dataDir
 
-    print(f"Running prepare on {inputDir} with Color range ({colorMin, colorMax}), imageSamplecount: {imageSampleCount} "
-          + f"backgroundPerImage: {backgroundPerImage}, testThreshhold: {testThreshhold}, valThreshhold: {valThreshhold}")
+    logger.info(f"Running prepare on {inputDir} with Color range ({colorMin, colorMax}), imageSamplecount: {imageSampleCount} "
+          + f"backgroundPerImage: {backgroundPerImage}, testThreshhold: {testThreshhold}, valThreshhold: {valThreshhold}, "
+          + f"executorBackend: {executorBackend}, workerCount: {workerCount}, chunkSize: {chunkSize}, "
+          + f"shard: {shardIndex} of {shardCount}")
 
     # AP will aggregate and upload metadata files within AP_Metadata in the result folder
     # This will be used in training to output results metadata
     resultMetadataFolder = f'{inputData.resultDir}\\AP_Metadata'
     create_dir_if_not_Exist(resultMetadataFolder)
 
-    images = find_images(inputDir, imageSampleCount)
-
     # During ingestion an aptable was generated and saved. AP will save a CSV version (with associated schema) automatically
     # this file contains all metadata for the images
     tableFile, uuid, schemaFile = read_input_meta_table(
@@ -91,74 +540,149 @@ def StartPrepare(inputData):
                          BOOLEAN_SCHEMA_TEMPLATE.format('IsValData'),
                          BOOLEAN_SCHEMA_TEMPLATE.format('IsTestData')]
     write_output_schema(resultMetadataFolder, uuid,
-                        schemaFile, columnDefinitions)
+                        schemaFile, columnDefinitions, tableName)
 
     # read the table file that contains metadata for each overlay we will work with
-    df = pd.read_csv(tableFile, sep=',', header='infer')
+    # only the name is used here, the other columns are propagated to the output table
+    with metrics.timer("load_table"):
+        df = load_meta_table(tableFile, schemaFile, ['name'])
 
-    # grab the current columns and create an empty data frame
-    # new data frame will contain the propagated metadata and new information about
+    # the new table will contain the propagated metadata and new information about
     # the created image.
-    cols = df.columns
-    emptyDf = pd.DataFrame(columns=cols)
-
-    # image mode we will be working with
-    mode = "RGB"
-
-    def generate_new_image(image, resultPath, df, colorMin, colorMax, backgroundPerImage):
-        # list of new image objects
-        newImages = []
-        for g in range(backgroundPerImage):
-            filename = path_leaf(image)
-            filename = os.path.splitext(filename)[0]
-            row = df.loc[df['name'] == filename]
-            color = random_color(colorMin, colorMax)
-            newFile = f"{resultPath}\\{filename}_{color}.png"
-            print(f"FileName: {filename}, newFile: {newFile}, color: {color}")
-
-            overlay = Image.open(image)
-
-            # generate background image with same size as original image
-            background = Image.new(mode, overlay.size, color)
-            background = background.convert(mode)
-            position = (0, 0)
-            background.paste(overlay, position, overlay)
-
-            # save the new file
-            background.save(newFile, "PNG")
-            newfilename = path_leaf(newFile)
-
-            # populate new data on the row
-            row['BackgroundColor'] = f'{color}'
-            row['NewPosition'] = f'{position}'
-            row['NewImage'] = f'{newfilename}'
-            row['ClipUuid'] = f'{uuid}'
-
-            # return image info for table results
-            newImages.append(row)
-
-        return newImages
-
-    # generate the images in parallel
-    results = Parallel(n_jobs=64, prefer="threads")(delayed(generate_new_image)(image, inputData.resultDir, df, colorMin, colorMax, backgroundPerImage)
-                                                    for image in images)
-
-    # flatten the results and iterate through them to insert them into the empty data frame
-    # here we will decide if the images are part of a data Training or Testing data
-    for row in reduce(list.__add__, results):
-        isTrainData = np.random.rand() > testThreshhold
-        row['IsTrainData'] = isTrainData
-
-        # only data that was in training should be used in validation
-        row['IsValData'] = isTrainData and (np.random.rand() < valThreshhold)
-        row['IsTestData'] = not isTrainData
-
-        # add row, and append new columns to it
-        emptyDf = emptyDf.append(row, ignore_index=True, sort=False)
+    tableBuilder = ResultTableBuilder(df, [('BackgroundColor', object),
+                                           ('NewPosition', object),
+                                           ('NewImage', object),
+                                           ('ClipUuid', object),
+                                           ('IsTrainData', bool),
+                                           ('IsValData', bool),
+                                           ('IsTestData', bool)])
+
+    # the manifest next to AP_Metadata records every completed job. When the task is retried the sampling plan
+    # and the completed jobs are taken from it, only missing or stale images are generated again.
+    manifest = PrepareManifest(f'{inputData.resultDir}\\{uuid}{shardSuffix}.prepare.manifest.jsonl',
+                               {"uuid": uuid, "ColorRangeMin": colorMin, "ColorRangeMax": colorMax,
+                                "ImageSampleCount": imageSampleCount, "BackgroundPerImage": backgroundPerImage,
+                                "TestThreshhold": testThreshhold, "ValThreshhold": valThreshhold,
+                                "Seed": settings.get("Seed"), "ShardIndex": shardIndex, "ShardCount": shardCount})
+    if manifest.load():
+        plan = manifest.plan
+        seed = manifest.seed
+        logger.info(f"Resuming from manifest {manifest.path} with {len(manifest.records)} completed images")
+    else:
+        # duplicate picks are grouped so each unique png is processed by a single job
+        seed = int(settings["Seed"]) if settings.get("Seed") else random.SystemRandom().getrandbits(63)
+        with metrics.timer("plan"):
+            plan = plan_image_jobs(find_base_images(inputDir), imageSampleCount, seed)
+
+    # colors, output names and splits of every job are drawn up front from the seed
+    with metrics.timer("plan"):
+        jobVariants = plan_job_variants(plan, backgroundPerImage, colorMin, colorMax, testThreshhold, valThreshhold, seed)
+
+    # the variants are drawn over the whole plan so a shard generates the same images as an unsharded run,
+    # the metadata row of each job of the shard is looked up once through the name index
+    nameIndex = build_name_index(df, 'name', duplicateNamePolicy)
+    jobs = resolve_image_jobs(shard_plan(plan, shardIndex, shardCount), nameIndex)
+
+    # completed images are kept, outputs of stale records (changed source or missing outputs) are removed.
+    # the hashes of the stale sources are handed to their jobs, the other sources are hashed while decoding
+    completed = set()
+    sourceHashes = {}
+    for image, multiplicity, rowPosition in jobs:
+        if image in manifest.records:
+            sourceHash = file_hash(image)
+            if manifest.is_complete(image, sourceHash):
+                completed.add(image)
+            else:
+                manifest.discard(image)
+                sourceHashes[image] = sourceHash
+    pendingJobs = [job for job in jobs if job[0] not in completed]
+    metrics.count("images_resumed", len(completed))
+    logger.info(f"{len(completed)} images already completed, generating {len(pendingJobs)}")
+    manifest.open(plan, seed)
+
+    # generate the images in parallel, in chunks of about ChunkSize jobs balanced by the bytes to composite,
+    # the png size times the number of picks, taken from the directory index without extra stat calls
+    directoryIndex = get_directory_index(inputDir)
+    weights = [(directoryIndex.size(image) or 1) * multiplicity for image, multiplicity, rowPosition in pendingJobs]
+    chunkCount = -(-len(pendingJobs) // max(1, chunkSize))
+    workUnits = [([(image, rowPosition, jobVariants[image][0], sourceHashes.get(image)) for image, multiplicity, rowPosition in chunk],
+                  inputData.resultDir, outputFormat, metricsLevel)
+                 for chunk in chunk_list_by_weight(pendingJobs, weights, chunkCount)]
+
+    def unit_results():
+        # the metrics of every work unit are merged as its results are consumed
+        for unitResults, unitMetrics in iter_work_units(generate_new_images, workUnits, executorBackend, workerCount):
+            metrics.merge(unitMetrics)
+            yield from unitResults
+
+    pipeline = None
+    if executorBackend == "pipeline":
+        # jobs flow through the stages one by one in plan order, the work units are not used
+        pipeline = prepare_pipeline(inputData.resultDir, outputFormat, metrics, pipelineWorkers, pipelineQueueSize)
+        results = pipeline.run((image, rowPosition, jobVariants[image][0], sourceHashes.get(image))
+                               for image, multiplicity, rowPosition in pendingJobs)
+    else:
+        results = unit_results()
 
     # name as .metadata.csv inside ap_metadata folder to ensure it gets picked up by the handler
     # the schema file next to it will define the types for the data in this table.
     # keep the UUID in the table to avoid collisions accross tasks. ap handler will merge all of them in the next step into one
     # and propegate the schema file.
-    emptyDf.to_csv(
-        f'{resultMetadataFolder}\\{uuid}.outputTable.metadata.csv', index=False)
+    shardWriter = ImageShardWriter(inputData.resultDir, f'{uuid}.images{shardSuffix}', shardBytes) if outputFormat == "tar" else None
+    with StreamingTableWriter(f'{resultMetadataFolder}\\{uuid}.{tableName}.metadata.csv', outputCompression) as tableWriter:
+        # walk the jobs in plan order, taking completed ones from the manifest and the others from the results
+        # as they complete. here we will decide if the images are part of a data Training or Testing data
+        for image, multiplicity, rowPosition in jobs:
+            if image in completed:
+                record = manifest.records[image]
+            else:
+                with metrics.timer("wait_results"):
+                    _, _, sourceHash, newImages = next(results)
+                split = jobVariants[image][1]
+                variants = []
+                for color, newFile, data in newImages:
+                    variant = {"color": list(color), "output": newFile, "split": split}
+                    if data is not None:
+                        with metrics.latency("write"):
+                            variant["output"] = shardWriter.add(newFile, data)
+                        variant["member"] = newFile
+                    variants.append(variant)
+
+                record = {"image": image, "hash": sourceHash, "rowPosition": rowPosition, "variants": variants}
+                manifest.add(record)
+
+            # add the new images to the new table along with the metadata row of the source image
+            for variant in record["variants"]:
+                split = variant["split"]
+                tableBuilder.add(rowPosition,
+                                 BackgroundColor=f'{tuple(variant["color"])}',
+                                 NewPosition=f'{OVERLAY_POSITION}',
+                                 NewImage=f'{variant.get("member") or path_leaf(variant["output"])}',
+                                 ClipUuid=f'{uuid}',
+                                 IsTrainData=split != TEST_SPLIT,
+                                 IsValData=split == VAL_SPLIT,
+                                 IsTestData=split == TEST_SPLIT)
+
+            if len(tableBuilder) >= outputChunkRows:
+                with metrics.timer("write_table"):
+                    tableWriter.write(tableBuilder.drain())
+
+        with metrics.timer("write_table"):
+            tableWriter.write(tableBuilder.drain())
+    # every result was consumed, this stops the executor or pipeline
+    results.close()
+    manifest.close()
+    if shardWriter is not None:
+        shardWriter.close()
+
+    logger.info(f"Processed {len(pendingJobs)} of {len(jobs)} unique images in {len(workUnits)} work units, wrote {tableWriter.rowsWritten} rows")
+    if pipeline is not None:
+        pipelineStats = pipeline.stats()
+        metrics.set_detail("pipeline", pipelineStats)
+        for stage, stats in pipelineStats["stages"].items():
+            logger.info(f"pipeline stage {stage}: {stats['workers']} workers, utilization {stats['utilization']}, "
+                        + f"queue depth mean {stats['queueDepthMean']} max {stats['queueDepthMax']}")
+    metrics.count("rows_written", tableWriter.rowsWritten)
+
+    metrics.add_time("total", time.perf_counter() - stageStart)
+    metrics.write(os.path.join(resultMetadataFolder, f'{uuid}{shardSuffix}.stage_metrics.json'))
@@ -1,46 +1,113 @@
 
 import glob
-import random
-import pandas as pd
+import fnmatch
+import importlib
+import time
 import os
-import numpy as np
 import ntpath
 import json
+import gzip
+import hashlib
+import io
+import tarfile
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from array import array
 from collections import OrderedDict
 import shutil
+import logging
+import math
+import sys
+
+class LazyModule:
+    '''
+        Stand-in for the module {name} that imports it on first attribute access. Lets the stages name their
+        heavy dependencies (pandas, numpy, PIL, torch, ...) at the top of the file without paying their import
+        time until they are used, which keeps the start of short tasks fast.
+
+        Args:
+            name: full name of the module, eg PIL.Image
+    '''
+
+    def __init__(self, name):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+
+    def _load(self):
+        module = self.__dict__["_module"]
+        if module is None:
+            module = self.__dict__["_module"] = importlib.import_module(self.__dict__["_name"])
+        return module
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+    def __setattr__(self, attribute, value):
+        setattr(self._load(), attribute, value)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = "loaded" if self.__dict__["_module"] is not None else "not loaded"
+        return f"<lazy module {self.__dict__['_name']} ({state})>"
+
+def lazy_import(name):
+    '''
+        Returns a LazyModule for {name}, the module is imported the first time one of its attributes is used.
+    '''
+    module = sys.modules.get(name)
+    return module if module is not None else LazyModule(name)
+
+pd = lazy_import("pandas")
+np = lazy_import("numpy")
+
+logger = logging.getLogger(__name__)
 
 BOOLEAN_SCHEMA_TEMPLATE = "\n## {0}\n`bool`\n"
 RECTFNULLABLE_SCHEMA_TEMPLATE = "\n## {0}\n`RectF?`\n"
 FLOATNULLABLE_SCHEMA_TEMPLATE = "\n## {0}\n`float?`\n"
 
+# pandas dtypes used to load the schema.md column types. Nullable dtypes are used throughout as the
+# tables leave missing values empty, any other type (string, RectF?, ...) is loaded as a category.
+SCHEMA_DTYPES = {"bool": "boolean", "bool?": "boolean",
+                 "int": "Int64", "int?": "Int64", "long": "Int64", "long?": "Int64",
+                 "float": "Float64", "float?": "Float64", "double": "Float64", "double?": "Float64"}
+
 def read_input_meta_table(inputDir):
     '''
-       Defines a method that will look within {inputDir} to find the first *.csv file
+       Defines a method that will look within {inputDir} to find the first *.csv file,
+       or the first *.csv.gz file written with OutputCompression gzip when there is no plain csv.
        This method assumes looking in a dedicated folder containing a single csv 
 
        Args:
             inputDir: Directory that contains the aptable as a csv.  
     '''
-    print(f'looking in {inputDir} for csv table')
-    tableFile = next((f for f in findFile(inputDir, "*.csv")), None)
+    logger.debug(f'looking in {inputDir} for csv table')
+    tableFile = next((f for f in findFile(inputDir, "*.csv") + findFile(inputDir, "*.csv.gz")), None)
+
+    # metadata table file is required.
+    if tableFile is None:
+        raise FileNotFoundError(f"Did not find a *.csv or *.csv.gz table file in {inputDir}")
     
-    print(f'found {tableFile}')
+    logger.info(f'found {tableFile}')
     tableFile = os.path.join(tableFile)
     
-    print(f'table file os path: {tableFile}')
+    logger.debug(f'table file os path: {tableFile}')
     tableFileName = path_leaf(tableFile)
 
-    print(f'parsing uuid from {tableFileName}')
+    logger.debug(f'parsing uuid from {tableFileName}')
     uuid = tableFileName.split(".")[0]
 
-    print(f'found Uuid: {uuid}')
+    logger.info(f'found Uuid: {uuid}')
 
-    print(f'looking for schema file .schema.md in {inputDir}')
+    logger.debug(f'looking for schema file .schema.md in {inputDir}')
     # look for schema file
     schemaFile = next((f for f in findFile(
         inputDir, "*.schema.md")), None)
 
-    print(f'found schemaFile: {schemaFile}')
+    logger.info(f'found schemaFile: {schemaFile}')
     schemaFile = os.path.join(schemaFile)
 
     # metadata table file is required.
@@ -49,10 +116,877 @@ def read_input_meta_table(inputDir):
 
     return tableFile, uuid, schemaFile
 
-def write_output_schema(resultMetadataFolder, uuid,  schemaFile, columnDefinitions):
+def schema_dtypes(schemaFile):
+    '''
+        Defines a method that maps the column types of {schemaFile} to the pandas dtypes used to load them,
+        see SCHEMA_DTYPES. Returns an ordered dict of column name to dtype.
+
+        Args:
+             schemaFile: schema.md file of the table
+    '''
+    return OrderedDict((name, SCHEMA_DTYPES.get(columnType, "category"))
+                       for name, columnType in parse_schema(schemaFile).items())
+
+def load_meta_table(tableFile, schemaFile, columns, passthrough=True):
+    '''
+        Defines a method that loads the aptable {tableFile} typed with the dtypes of its {schemaFile}.
+        Columns without a schema definition are loaded as categories. The table is parsed with the
+        pyarrow engine, or the default engine when pyarrow is not installed.
+
+        Args:
+             tableFile: csv file of the table
+             schemaFile: schema.md file of the table
+             columns: columns the stage uses, raises if any of them is missing from the table
+             passthrough: load the other columns as well, required when they are propagated to the output table
+    '''
+    header = list(pd.read_csv(tableFile, nrows=0).columns)
+    missing = [column for column in columns if column not in header]
+    if missing:
+        raise ValueError(f"Table {tableFile} is missing the columns {missing}")
+
+    usecols = header if passthrough else [column for column in header if column in columns]
+    dtypes = schema_dtypes(schemaFile) if schemaFile and os.path.exists(schemaFile) else {}
+    dtype = {column: dtypes.get(column, "category") for column in usecols}
+
+    try:
+        import pyarrow
+        engine = "pyarrow"
+    except ImportError:
+        engine = "c"
+    logger.info(f'loading {len(usecols)} of {len(header)} columns from {tableFile} with the {engine} engine')
+    return pd.read_csv(tableFile, sep=',', header=0, usecols=usecols, dtype=dtype, engine=engine)
+
+def build_name_index(df, column='name', duplicatePolicy='first'):
+    '''
+        Builds a {column} value to row position index over {df} so rows can be looked up
+        in O(1) instead of scanning the table for every image.
+
+        Args:
+            df: aptable data frame
+            column: column holding the names to index
+            duplicatePolicy: first keeps the position of the first row with a name,
+                             error raises if a name is used by more than one row
+    '''
+    if duplicatePolicy not in ('first', 'error'):
+        raise ValueError(f"Unknown duplicate policy {duplicatePolicy}, expected first or error")
+
+    nameIndex = {}
+    duplicates = []
+    for position, name in enumerate(df[column].astype(str)):
+        if name in nameIndex:
+            duplicates.append(name)
+        else:
+            nameIndex[name] = position
+
+    if duplicates:
+        if duplicatePolicy == 'error':
+            raise ValueError(f"Found {len(duplicates)} duplicate values in column {column}: {duplicates[:10]}")
+        logger.warning(f'found {len(duplicates)} duplicate values in column {column}, using the first row for each: {duplicates[:10]}')
+
+    return nameIndex
+
+class ResultTableBuilder:
+    '''
+        Builds an output table from rows of a source table plus new columns.
+        Rows are added as the position of the source row they propagate and the values of the
+        new columns. Values are kept in per column buffers and the data frame is created in one
+        step by build, instead of appending to a data frame row by row.
+
+        Args:
+            sourceDf: table the propagated metadata is taken from
+            columnTypes: list of (column, dtype) pairs for the new columns, in output order.
+                         a column that already exists in {sourceDf} is overwritten in place.
+    '''
+
+    def __init__(self, sourceDf, columnTypes):
+        self.sourceDf = sourceDf
+        self.columnTypes = OrderedDict(columnTypes)
+        self._positions = array('q')
+        self._columns = {column: [] for column in self.columnTypes}
+
+    def __len__(self):
+        return len(self._positions)
+
+    def add(self, position, **values):
+        '''
+            Adds a row propagating source row {position}. New columns missing from {values} are left empty.
+            Args:
+                position: row position within the source table
+                values: value for each new column
+        '''
+        self._positions.append(position)
+        for column, buffer in self._columns.items():
+            buffer.append(values.get(column))
+
+    def drain(self):
+        '''
+            Returns the output data frame for the rows added since the last drain and clears them.
+            Used with StreamingTableWriter to write the output table in chunks.
+        '''
+        table = self.build()
+        self._positions = array('q')
+        self._columns = {column: [] for column in self.columnTypes}
+        return table
+
+    def build(self):
+        '''
+            Returns the output data frame with the source columns followed by the new columns.
+        '''
+        positions = np.frombuffer(self._positions, dtype=np.int64) if self._positions else np.empty(0, dtype=np.int64)
+        table = self.sourceDf.iloc[positions].reset_index(drop=True)
+
+        newColumns = OrderedDict()
+        for column, dtype in self.columnTypes.items():
+            values = pd.Series(self._columns[column], dtype=dtype)
+            if column in table.columns:
+                table[column] = values
+            else:
+                newColumns[column] = values
+
+        if newColumns:
+            table = pd.concat([table, pd.DataFrame(newColumns)], axis=1)
+        return table
+
+class StreamingTableWriter:
+    '''
+        Writes an output table to {path} incrementally, one chunk of rows at a time, so rows are on disk
+        as work completes and memory does not grow with the size of the table.
+        The header is written with the first chunk, each chunk is flushed once written.
+
+        Keep {path} named {uuid}.outputTable.metadata.csv next to the schema written by write_output_schema
+        so the AP handler picks it up. gzip compressed tables are written to {path}.gz.
+
+        Args:
+            path: csv file to write
+            compression: None or 'gzip'
+    '''
+
+    def __init__(self, path, compression=None):
+        if compression not in (None, 'gzip'):
+            raise ValueError(f"Unknown compression {compression}, expected gzip or None")
+
+        self.path = f'{path}.gz' if compression == 'gzip' else path
+        self.rowsWritten = 0
+        self._header = True
+        if compression == 'gzip':
+            self._file = gzip.open(self.path, 'wt', newline='', encoding='utf8')
+        else:
+            self._file = open(self.path, 'w', newline='', encoding='utf8')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def write(self, table):
+        '''
+            Appends the rows of {table} to the output. Every chunk must have the same columns.
+            Args:
+                table: data frame with the rows to write
+        '''
+        if table.empty and not self._header:
+            return
+        table.to_csv(self._file, header=self._header, index=False)
+        self._file.flush()
+        self._header = False
+        self.rowsWritten += len(table)
+
+    def close(self):
+        '''
+            Closes the output file.
+        '''
+        self._file.close()
+
+class ImageShardWriter:
+    '''
+        Packs images into uncompressed tar shards instead of writing one file per image.
+        Shards are named {prefix}-{n:05d}.tar in {outputDir}, a new shard is started once the current one
+        reaches {shardBytes}. Next to every shard a {prefix}-{n:05d}.index.jsonl holds one line per member
+        with its name and the offset and size of its data within the tar, see ImageShardReader.
+        Each image is flushed to the shard and its index before add returns, shards of an earlier run are kept
+        and numbering continues after them.
+
+        Args:
+            outputDir: directory to write the shards to
+            prefix: shard name prefix, use the clip uuid to avoid collisions when clips are merged
+            shardBytes: size at which a shard is closed
+    '''
+
+    def __init__(self, outputDir, prefix, shardBytes):
+        self.outputDir = outputDir
+        self.prefix = prefix
+        self.shardBytes = shardBytes
+        self.shardPath = None
+        self._shardNumber = len(findFile(outputDir, f'{prefix}-*.tar'))
+        self._tar = None
+        self._index = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def add(self, name, data):
+        '''
+            Adds the encoded image {data} as member {name} and returns the path of the shard holding it.
+            Args:
+                name: member name, the NewImage value of the image
+                data: encoded image bytes
+        '''
+        if self._tar is None or self._tar.offset >= self.shardBytes:
+            self._open_next_shard()
+
+        member = tarfile.TarInfo(name)
+        member.size = len(data)
+        offset = self._tar.offset + len(member.tobuf(self._tar.format, self._tar.encoding, self._tar.errors))
+        self._tar.addfile(member, io.BytesIO(data))
+        self._tar.fileobj.flush()
+
+        self._index.write(json.dumps({"name": name, "offset": offset, "size": len(data)}) + "\n")
+        self._index.flush()
+        return self.shardPath
+
+    def close(self):
+        '''
+            Closes the current shard.
+        '''
+        if self._tar is not None:
+            self._tar.close()
+            self._index.close()
+            self._tar = None
+
+    def _open_next_shard(self):
+        self.close()
+        shardName = f'{self.prefix}-{self._shardNumber:05d}'
+        self._shardNumber += 1
+        self.shardPath = os.path.join(self.outputDir, f'{shardName}.tar')
+        self._tar = tarfile.open(self.shardPath, 'w', format=tarfile.PAX_FORMAT)
+        self._index = open(os.path.join(self.outputDir, f'{shardName}.index.jsonl'), 'w', encoding='utf8')
+
+class ImageShardReader:
+    '''
+        Reads images packed by ImageShardWriter. All shard indexes within {inputDir} are loaded up front,
+        images are read with a single seek and read on the shard, without parsing the tar.
+
+        Args:
+            inputDir: directory containing the tar shards and their .index.jsonl files
+    '''
+
+    def __init__(self, inputDir):
+        self.locations = {}
+        for indexFile in sorted(findFile(inputDir, '*.index.jsonl')):
+            shardPath = indexFile[:-len('.index.jsonl')] + '.tar'
+            with open(indexFile, encoding='utf8') as openFile:
+                for line in openFile:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # last line cut off when the writing task was killed
+                        break
+                    self.locations[entry["name"]] = (shardPath, entry["offset"], entry["size"])
+        self._files = {}
+
+    def __len__(self):
+        return len(self.locations)
+
+    def __contains__(self, name):
+        return name in self.locations
+
+    def __getstate__(self):
+        # open shard files are not shared with DataLoader worker processes, each opens its own
+        state = self.__dict__.copy()
+        state['_files'] = {}
+        return state
+
+    def sort_key(self, name):
+        '''
+            Returns a key that orders images by shard and offset, reading in that order is sequential on disk.
+        '''
+        shardPath, offset, size = self.locations[name]
+        return shardPath, offset
+
+    def read(self, name):
+        '''
+            Returns the encoded bytes of image {name}.
+        '''
+        shardPath, offset, size = self.locations[name]
+        shard = self._files.get(shardPath)
+        if shard is None:
+            shard = self._files[shardPath] = open(shardPath, 'rb')
+        shard.seek(offset)
+        return shard.read(size)
+
+    def close(self):
+        for shard in self._files.values():
+            shard.close()
+        self._files = {}
+
+class DecodedImageCache:
+    '''
+        Decoded images stored back to back as raw uint8 pixels in {path}.pixels.u8, read through a memory map
+        so later eval passes and DataLoader workers get the pixels without decoding or copying them.
+        {path}.index.jsonl holds one line per image with its name and the offset and shape of its pixels.
+        Images are appended to both files as they are added, the pixels are flushed before their index line
+        so an index entry never points past the data, a run killed while adding keeps the images added before.
+
+        Args:
+            path: path of the cache files without extension, use the dataset uuid so datasets don't share a cache
+    '''
+
+    def __init__(self, path):
+        self.pixelsPath = f'{path}.pixels.u8'
+        self.indexPath = f'{path}.index.jsonl'
+        self.locations = {}
+        self._indexBytes = 0
+        if os.path.exists(self.indexPath):
+            with open(self.indexPath, 'rb') as openFile:
+                for line in openFile:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # last line cut off when the run was killed, it is overwritten by the next add
+                        break
+                    self.locations[entry["name"]] = (entry["offset"], tuple(entry["shape"]))
+                    self._indexBytes += len(line)
+        self._pixels = None
+        self._pixelsFile = None
+        self._index = None
+
+    def __len__(self):
+        return len(self.locations)
+
+    def __contains__(self, name):
+        return name in self.locations
+
+    def __getstate__(self):
+        # DataLoader workers map the file themselves, only reading is supported there
+        state = self.__dict__.copy()
+        state.update(_pixels=None, _pixelsFile=None, _index=None)
+        return state
+
+    def add(self, name, pixels):
+        '''
+            Appends the decoded image {pixels}, a uint8 array, as image {name}.
+        '''
+        pixels = np.ascontiguousarray(pixels, dtype=np.uint8)
+        if self._pixelsFile is None:
+            self._pixelsFile = open(self.pixelsPath, 'ab')
+            if os.path.exists(self.indexPath):
+                os.truncate(self.indexPath, self._indexBytes)
+            self._index = open(self.indexPath, 'a', encoding='utf8')
+
+        offset = self._pixelsFile.tell()
+        self._pixelsFile.write(pixels.data)
+        self._pixelsFile.flush()
+        self._index.write(json.dumps({"name": name, "offset": offset, "shape": list(pixels.shape)}) + "\n")
+        self._index.flush()
+        self.locations[name] = (offset, pixels.shape)
+        # the map only covers the file as it was when mapped, it is mapped again on the next read
+        self._pixels = None
+
+    def read(self, name):
+        '''
+            Returns the pixels of image {name} as a read-only array backed by the memory map.
+        '''
+        offset, shape = self.locations[name]
+        if self._pixels is None:
+            self._pixels = np.memmap(self.pixelsPath, dtype=np.uint8, mode='r')
+        return np.asarray(self._pixels[offset:offset + math.prod(shape)]).reshape(shape)
+
+    def close(self):
+        if self._pixelsFile is not None:
+            self._pixelsFile.close()
+            self._index.close()
+            self._pixelsFile = None
+            self._index = None
+        self._pixels = None
+
+def create_embedding_matrix(path, rowCount, dimension=512):
+    '''
+        Creates the .npy file {path} holding a float32 matrix of {rowCount} embeddings of {dimension} values
+        and returns it memory-mapped for writing. Row n belongs to row n of the output table, rows without
+        an embedding stay NaN. Open it again with load_embedding_matrix.
+    '''
+    embeddings = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(rowCount, dimension))
+    embeddings[:] = np.nan
+    return embeddings
+
+def load_embedding_matrix(path):
+    '''
+        Returns the embedding matrix written by create_embedding_matrix, memory-mapped read only.
+    '''
+    return np.load(path, mmap_mode='r')
+
+def _normalized_block(embeddings, start, end):
+    # unit rows so the dot product is the cosine similarity, rows without an embedding are marked invalid
+    block = np.asarray(embeddings[start:end], dtype=np.float32)
+    valid = ~np.isnan(block).any(axis=1)
+    norms = np.linalg.norm(np.where(valid[:, None], block, 0), axis=1)
+    valid &= norms > 0
+    block = np.where(valid[:, None], block, 0) / np.where(valid, norms, 1)[:, None]
+    return block, valid
+
+def _iter_similarity_blocks(embeddings, queries, blockRows):
+    # yields the cosine similarities of every block of queries against every block of embeddings,
+    # pairs involving a row without an embedding are -inf and so is a row against itself when queries is None
+    for queryStart in range(0, len(queries), blockRows):
+        queryEnd = min(queryStart + blockRows, len(queries))
+        queryBlock, queryValid = _normalized_block(queries, queryStart, queryEnd)
+        for baseStart in range(0, len(embeddings), blockRows):
+            baseEnd = min(baseStart + blockRows, len(embeddings))
+            baseBlock, baseValid = _normalized_block(embeddings, baseStart, baseEnd)
+            similarities = queryBlock @ baseBlock.T
+            similarities[~queryValid] = -np.inf
+            similarities[:, ~baseValid] = -np.inf
+            if queries is embeddings:
+                rows = np.arange(max(queryStart, baseStart), min(queryEnd, baseEnd))
+                similarities[rows - queryStart, rows - baseStart] = -np.inf
+            yield queryStart, baseStart, similarities
+
+def nearest_neighbours(embeddings, queries=None, k=5, blockRows=2048):
+    '''
+        Finds the {k} rows of {embeddings} with the highest cosine similarity to every row of {queries}.
+        The similarities are computed as matrix products of blocks of {blockRows} rows, memory stays bounded
+        by the block size whatever the number of rows, so memory-mapped matrices can be searched.
+
+        Args:
+            embeddings: (n, d) matrix, rows holding NaN have no embedding and are never returned
+            queries: (m, d) matrix, None searches the neighbours of every row of {embeddings} but itself
+            k: number of neighbours per query
+            blockRows: number of rows multiplied at once
+        Returns:
+            (indices, similarities) (m, k) arrays sorted by decreasing similarity, the row numbers within
+            {embeddings} of the neighbours. Missing neighbours have index -1 and similarity -inf.
+    '''
+    queries = embeddings if queries is None else queries
+    indices = np.full((len(queries), k), -1, dtype=np.int64)
+    similarities = np.full((len(queries), k), -np.inf, dtype=np.float32)
+    for queryStart, baseStart, blockSimilarities in _iter_similarity_blocks(embeddings, queries, blockRows):
+        rows = slice(queryStart, queryStart + len(blockSimilarities))
+        # keep the best k of the neighbours found so far and of this block
+        candidateSimilarities = np.concatenate([similarities[rows], blockSimilarities], axis=1)
+        candidateIndices = np.concatenate(
+            [indices[rows], np.broadcast_to(np.arange(baseStart, baseStart + blockSimilarities.shape[1]),
+                                            blockSimilarities.shape)], axis=1)
+        best = np.argsort(-candidateSimilarities, axis=1, kind='stable')[:, :k]
+        similarities[rows] = np.take_along_axis(candidateSimilarities, best, axis=1)
+        indices[rows] = np.take_along_axis(candidateIndices, best, axis=1)
+
+    indices[np.isneginf(similarities)] = -1
+    return indices, similarities
+
+def similar_pairs(embeddings, threshold, blockRows=2048):
+    '''
+        Finds every pair of rows of {embeddings} with a cosine similarity of at least {threshold},
+        eg near duplicate images or faces of the same identity, using blocked matrix products like nearest_neighbours.
+
+        Args:
+            embeddings: (n, d) matrix, rows holding NaN have no embedding and are skipped
+            threshold: minimum cosine similarity of a pair
+            blockRows: number of rows multiplied at once
+        Returns:
+            (first, second, similarity) arrays of the pairs with first < second, sorted by first and second
+    '''
+    firsts, seconds, pairSimilarities = [], [], []
+    for queryStart, baseStart, blockSimilarities in _iter_similarity_blocks(embeddings, embeddings, blockRows):
+        if baseStart + blockSimilarities.shape[1] <= queryStart:
+            # every pair of these blocks was found the other way round
+            continue
+        queryRows, baseRows = np.nonzero(blockSimilarities >= threshold)
+        queryRows += queryStart
+        baseRows += baseStart
+        upper = queryRows < baseRows
+        firsts.append(queryRows[upper])
+        seconds.append(baseRows[upper])
+        pairSimilarities.append(blockSimilarities[queryRows[upper] - queryStart, baseRows[upper] - baseStart])
+
+    if not firsts:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    first, second, similarity = np.concatenate(firsts), np.concatenate(seconds), np.concatenate(pairSimilarities)
+    order = np.lexsort((second, first))
+    return first[order], second[order], similarity[order]
+
+class BackgroundWriterPool:
+    '''
+        Runs file writes on a pool of background threads so encoding and disk I/O stay off the critical path.
+        At most {maxPending} writes are queued or running, submit blocks once the limit is reached so the
+        producer cannot run ahead of the disk. A failed write does not stop the others, the failures are
+        collected and raised by close.
+
+        Args:
+            workerCount: number of writer threads
+            maxPending: maximum number of writes queued or running at a time
+    '''
+
+    def __init__(self, workerCount, maxPending):
+        self.written = 0
+        self.errors = []
+        self._executor = ThreadPoolExecutor(max_workers=workerCount)
+        self._slots = threading.BoundedSemaphore(maxPending)
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        # do not hide the error that ended the with block behind the write errors
+        self.close(raiseErrors=excType is None)
+
+    def submit(self, function, *args):
+        '''
+            Queues the call {function}(*{args}), blocking while {maxPending} writes are outstanding.
+        '''
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(function, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(self._write_done)
+
+    def close(self, raiseErrors=True):
+        '''
+            Waits for all queued writes and raises if any of them failed.
+        '''
+        self._executor.shutdown(wait=True)
+        if raiseErrors and self.errors:
+            raise RuntimeError(f"{len(self.errors)} background writes failed, first error: {self.errors[0]}") from self.errors[0]
+
+    def _write_done(self, future):
+        self._slots.release()
+        error = future.exception()
+        with self._lock:
+            if error is None:
+                self.written += 1
+            else:
+                self.errors.append(error)
+
+class LocalRun:
+    '''
+        File backed stand-in for the AzureML run returned by Run.get_context(), used for tests and offline runs.
+        Supports the logging calls used by the stages, each call is appended to {path} as a json line.
+
+        Args:
+            path: json lines file to append the logged metrics to
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            create_dir_if_not_Exist(directory)
+
+    def log(self, name, value, description=''):
+        self._append({"type": "scalar", "name": name, "value": value})
+
+    def log_list(self, name, value, description=''):
+        self._append({"type": "list", "name": name, "value": list(value)})
+
+    def log_table(self, name, value, description=''):
+        self._append({"type": "table", "name": name, "value": {column: list(values) for column, values in value.items()}})
+
+    def log_row(self, name, description=None, **kwargs):
+        self._append({"type": "row", "name": name, "value": kwargs})
+
+    def _append(self, entry):
+        with open(self.path, 'a', encoding='utf8') as openFile:
+            openFile.write(json.dumps(entry, default=_json_value) + "\n")
+
+def _json_value(value):
+    # numpy scalars logged by the stages are not json serializable as is
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def get_run_context(localLogPath=None):
+    '''
+        Returns the run metrics are logged to. This is the AzureML run of the current context,
+        or a LocalRun writing to {localLogPath} when a path is given or AzureML is not installed.
+
+        Args:
+            localLogPath: json lines file for the local stand-in, defaults to outputs/local_run.metrics.jsonl
+    '''
+    if localLogPath is None:
+        try:
+            from azureml.core.run import Run
+            return Run.get_context()
+        except ImportError:
+            localLogPath = os.path.join("outputs", "local_run.metrics.jsonl")
+    logger.info(f'logging metrics to local run {localLogPath}')
+    return LocalRun(localLogPath)
+
+class MetricsBuffer:
+    '''
+        Accumulates metric values in NumPy arrays and logs them to {run} in batches of {flushSize} values
+        with run.log_list, instead of one run.log call per value.
+        close flushes the remaining values and logs the count, mean, p50 and p95 of every metric,
+        computed locally over all values.
+
+        Args:
+            run: AzureML run or LocalRun, see get_run_context
+            flushSize: number of values of a metric sent per log_list call
+    '''
+
+    def __init__(self, run, flushSize=250):
+        self.run = run
+        self.flushSize = flushSize
+        self._values = OrderedDict()
+        self._counts = {}
+        self._flushed = {}
+
+    def add(self, name, value):
+        '''
+            Adds a single value of metric {name}.
+        '''
+        self.extend(name, [value])
+
+    def extend(self, name, values):
+        '''
+            Adds the {values} of metric {name}, logging every full batch.
+        '''
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if name not in self._values:
+            self._values[name] = np.empty(max(len(values), self.flushSize), dtype=np.float64)
+            self._counts[name] = 0
+            self._flushed[name] = 0
+
+        count = self._counts[name]
+        buffer = self._values[name]
+        if count + len(values) > len(buffer):
+            # grow geometrically so adding values stays amortized O(1)
+            buffer = self._values[name] = np.resize(buffer, max(2 * len(buffer), count + len(values)))
+        buffer[count:count + len(values)] = values
+        self._counts[name] = count + len(values)
+
+        while self._counts[name] - self._flushed[name] >= self.flushSize:
+            self._flush(name, self._flushed[name] + self.flushSize)
+
+    def summary(self):
+        '''
+            Returns count, mean, p50 and p95 for every metric.
+        '''
+        stats = OrderedDict()
+        for name, buffer in self._values.items():
+            values = buffer[:self._counts[name]]
+            if len(values) == 0:
+                continue
+            p50, p95 = np.percentile(values, [50, 95])
+            stats[name] = {"count": len(values), "mean": float(values.mean()), "p50": float(p50), "p95": float(p95)}
+        return stats
+
+    def close(self):
+        '''
+            Logs the values not sent yet and the summary statistics of every metric.
+        '''
+        for name in self._values:
+            if self._counts[name] > self._flushed[name]:
+                self._flush(name, self._counts[name])
+
+        stats = self.summary()
+        if stats:
+            self.run.log_table("summary", {"metric": list(stats),
+                                           "count": [s["count"] for s in stats.values()],
+                                           "mean": [s["mean"] for s in stats.values()],
+                                           "p50": [s["p50"] for s in stats.values()],
+                                           "p95": [s["p95"] for s in stats.values()]})
+        return stats
+
+    def _flush(self, name, end):
+        start = self._flushed[name]
+        self.run.log_list(name, self._values[name][start:end].tolist())
+        self._flushed[name] = end
+
+def configure_logging(level="INFO"):
+    '''
+        Configures the logging of the task to write to stdout at {level}, eg DEBUG, INFO or WARNING.
+        The stages log through the logging module, DEBUG adds a line per image.
+    '''
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s', stream=sys.stdout)
+    logging.getLogger().setLevel(level.upper())
+
+class _NullTimer:
+    '''
+        Timer handed out while the metrics are disabled, entering and leaving it does nothing.
+    '''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+class _Timer:
+    def __init__(self, record, name):
+        self._record = record
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self._record(self._name, time.perf_counter() - self._start)
+        return False
+
+class StageMetrics:
+    '''
+        Instrumentation of a stage: timers of the steps of the stage, counters and per-image latency histograms.
+        What is recorded follows the {level}, like a log level:
+            OFF     nothing, every call returns right away and timers are a shared no-op
+            INFO    stage timers and counters
+            DEBUG   stage timers, counters and per-image latency histograms
+        Histograms use power of two buckets from 1 microsecond up, percentiles are reported as the upper edge of their bucket.
+        Metrics recorded in worker processes are sent back with snapshot and added with merge.
+
+        Args:
+            stage: name of the stage, written into the metrics file
+            level: OFF, INFO or DEBUG, or a logging level number
+    '''
+
+    BUCKETS = 32
+
+    def __init__(self, stage, level="INFO"):
+        self.stage = stage
+        if isinstance(level, str):
+            level = logging.CRITICAL + 1 if level.upper() == "OFF" else logging.getLevelName(level.upper())
+        self.level = level if isinstance(level, int) else logging.INFO
+        self.enabled = self.level <= logging.INFO
+        self.histogramsEnabled = self.level <= logging.DEBUG
+        self.timers = OrderedDict()
+        self.counters = OrderedDict()
+        self.histograms = OrderedDict()
+        self.details = OrderedDict()
+        self._lock = threading.Lock()
+
+    def timer(self, name):
+        '''
+            Returns a context manager adding the time spent in it to the stage timer {name}.
+        '''
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self.add_time, name)
+
+    def latency(self, name):
+        '''
+            Returns a context manager recording the time spent in it in the latency histogram {name}.
+        '''
+        if not self.histogramsEnabled:
+            return _NULL_TIMER
+        return _Timer(self.observe, name)
+
+    def observe(self, name, seconds):
+        '''
+            Records a latency of {seconds} in the histogram {name}.
+        '''
+        if not self.histogramsEnabled:
+            return
+        bucket = min(self.BUCKETS - 1, max(0, math.ceil(math.log2(max(seconds * 1e6, 1.0)))))
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = {"count": 0, "sum": 0.0, "min": seconds, "max": seconds,
+                                                     "buckets": [0] * self.BUCKETS}
+            histogram["count"] += 1
+            histogram["sum"] += seconds
+            histogram["min"] = min(histogram["min"], seconds)
+            histogram["max"] = max(histogram["max"], seconds)
+            histogram["buckets"][bucket] += 1
+
+    def count(self, name, value=1):
+        '''
+            Adds {value} to the counter {name}.
+        '''
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_detail(self, name, value):
+        '''
+            Records the json serializable {value} as {name}, eg the stats of a pipeline, written with the summary.
+        '''
+        if not self.enabled:
+            return
+        with self._lock:
+            self.details[name] = value
+
+    def snapshot(self):
+        '''
+            Returns the recorded metrics as plain values, cheap to send back from a worker process.
+            None when the metrics are disabled.
+        '''
+        if not self.enabled:
+            return None
+        with self._lock:
+            return json.loads(json.dumps({"timers": self.timers, "counters": self.counters, "histograms": self.histograms,
+                                          "details": self.details}))
+
+    def merge(self, snapshot):
+        '''
+            Adds the metrics of a {snapshot} taken in another process to these metrics.
+        '''
+        if snapshot is None or not self.enabled:
+            return
+        with self._lock:
+            for name, seconds in snapshot["timers"].items():
+                self.timers[name] = self.timers.get(name, 0.0) + seconds
+            for name, value in snapshot["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for name, other in snapshot["histograms"].items():
+                histogram = self.histograms.get(name)
+                if histogram is None:
+                    self.histograms[name] = other
+                    continue
+                histogram["count"] += other["count"]
+                histogram["sum"] += other["sum"]
+                histogram["min"] = min(histogram["min"], other["min"])
+                histogram["max"] = max(histogram["max"], other["max"])
+                histogram["buckets"] = [a + b for a, b in zip(histogram["buckets"], other["buckets"])]
+            self.details.update(snapshot.get("details", {}))
+
+    def summary(self):
+        '''
+            Returns the metrics with the count, mean, min, max, p50, p95 and p99 of every histogram, in seconds.
+        '''
+        histograms = OrderedDict()
+        with self._lock:
+            for name, histogram in self.histograms.items():
+                cumulative = np.cumsum(histogram["buckets"])
+                percentiles = {f"p{p}": min(histogram["max"], 2.0 ** int(np.searchsorted(cumulative, histogram["count"] * p / 100.0)) / 1e6)
+                               for p in (50, 95, 99)}
+                histograms[name] = dict({"count": histogram["count"], "mean": histogram["sum"] / histogram["count"],
+                                         "min": histogram["min"], "max": histogram["max"]}, **percentiles)
+            return {"stage": self.stage, "level": logging.getLevelName(self.level),
+                    "timers": dict(self.timers), "counters": dict(self.counters), "histograms": histograms,
+                    "details": dict(self.details)}
+
+    def write(self, path):
+        '''
+            Writes the summary of the metrics to the json file {path}. Nothing is written while the metrics are disabled.
+        '''
+        if not self.enabled:
+            return
+        with open(path, 'w', encoding='utf8') as openFile:
+            json.dump(self.summary(), openFile, indent=2)
+        logger.info(f'wrote stage metrics to {path}')
+
+    def add_time(self, name, seconds):
+        '''
+            Adds {seconds} to the stage timer {name}.
+        '''
+        if not self.enabled:
+            return
+        with self._lock:
+            self.timers[name] = self.timers.get(name, 0.0) + seconds
+
+def write_output_schema(resultMetadataFolder, uuid,  schemaFile, columnDefinitions, tableName='outputTable'):
     '''
         Defines a method that will take the input {schemaFile}, copy it to {resultmetadataFolder}
-        with name {uuid}.outputTable.metadata.schema.md. The schema.md is a constant, as the AP system will
+        with name {uuid}.{tableName}.metadata.schema.md. The schema.md is a constant, as the AP system will
         pick this up automatically when we load the table if the file is next to the table.
         Once the file is copied the {columnDefinitions} will be added to the new schema.
 
@@ -61,44 +995,354 @@ def write_output_schema(resultMetadataFolder, uuid,  schemaFile, columnDefinitio
              uuid: object ID to write into the file name
              schemaFile: originating schema file to append additional definitions to
              columnDefinitions: new definitions to add to the schema
+             tableName: name of the table the schema is for, eg outputTable.shard001of004 for a sharded task
     '''
     # copy the current schema of the table to the output result. This is where additional
     # type definitions can be specified to enable loading of typed tables within tooling.
-    newSchema = os.path.join(resultMetadataFolder, f'{uuid}.outputTable.metadata.schema.md')
+    newSchema = os.path.join(resultMetadataFolder, f'{uuid}.{tableName}.metadata.schema.md')
 
-    print(f'copying {schemaFile} to {newSchema}')
+    logger.info(f'copying {schemaFile} to {newSchema}')
     shutil.copy(schemaFile, newSchema)
     
     # append new typed columns to schema file
     with open(newSchema, 'a') as openFile:
         for col in columnDefinitions:
-            print(f'adding {col} to schema')
+            logger.debug(f'adding {col} to schema')
             openFile.write(col)
 
-def random_color(min, max):
+def parse_schema(schemaFile):
+    '''
+        Defines a method that reads the column definitions of a schema.md file. Every column is a
+        "## {name}" heading followed by its type in backticks, eg `float?`.
+        Returns an ordered dict of column name to type.
+
+        Args:
+             schemaFile: schema.md file to read
+    '''
+    columns = OrderedDict()
+    name = None
+    with open(schemaFile, 'r', encoding='utf8') as openFile:
+        for line in openFile:
+            line = line.strip()
+            if line.startswith('## '):
+                name = line[3:].strip()
+            elif name is not None and line.startswith('`') and line.endswith('`') and len(line) > 1:
+                columns[name] = line[1:-1]
+                name = None
+    return columns
+
+def write_schema(schemaPath, columns):
+    '''
+        Defines a method that writes the {columns} definitions, name to type, as a schema.md file to {schemaPath}.
+        The inverse of parse_schema.
+
+        Args:
+             schemaPath: schema.md file to write
+             columns: ordered dict of column name to type
+    '''
+    with open(schemaPath, 'w', encoding='utf8') as openFile:
+        for name, columnType in columns.items():
+            openFile.write(f'## {name}\n`{columnType}`\n\n')
+
+def chunk_list(items, chunkSize):
+    '''
+        Helper function to split {items} into consecutive chunks of at most {chunkSize} items.
+        Args:
+             items: list to split
+             chunkSize: maximum number of items per chunk
+    '''
+    chunkSize = max(1, chunkSize)
+    return [items[i:i + chunkSize] for i in range(0, len(items), chunkSize)]
+
+def chunk_list_by_weight(items, weights, chunkCount):
+    '''
+        Helper function to split {items} into at most {chunkCount} consecutive chunks of roughly equal
+        total weight, so work units with large items do not hold up the others. Item order is kept.
+        Args:
+             items: list to split
+             weights: cost of each item, eg its file size
+             chunkCount: maximum number of chunks
+    '''
+    chunkCount = max(1, min(chunkCount, len(items)))
+    totalWeight = float(sum(weights))
+    if totalWeight <= 0:
+        return chunk_list(items, -(-len(items) // chunkCount))
+
+    # cut before an item when the running total ends closer to the next multiple of the target weight without it
+    target = totalWeight / chunkCount
+    chunks = []
+    chunk, cumulativeWeight = [], 0.0
+    for item, weight in zip(items, weights):
+        boundary = target * (len(chunks) + 1)
+        if chunk and len(chunks) < chunkCount - 1 and cumulativeWeight + weight - boundary > boundary - cumulativeWeight:
+            chunks.append(chunk)
+            chunk = []
+        chunk.append(item)
+        cumulativeWeight += weight
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+def iter_work_units(function, workUnits, backend="threads", workerCount=None):
+    '''
+        Executes {function} once per work unit and yields the results in work unit order as they complete,
+        so callers can consume results without holding all of them.
+
+        Args:
+             function: function to run, for the processes backend it must be defined at module level
+             workUnits: list of argument tuples, one per call of {function}
+             backend: threads, processes or serial. processes avoids GIL contention but pickles the
+                      arguments and results, keep them small.
+             workerCount: number of workers, defaults to the cpu count
+    '''
+    if backend == "serial":
+        return (function(*unit) for unit in workUnits)
+
+    from joblib import Parallel, delayed
+
+    joblibBackends = {"threads": "threading", "processes": "loky"}
+    if backend not in joblibBackends:
+        raise ValueError(f"Unknown executor backend {backend}, expected one of serial, {', '.join(joblibBackends)}")
+
+    workerCount = workerCount or os.cpu_count() or 1
+    return Parallel(n_jobs=workerCount, backend=joblibBackends[backend], return_as="generator")(delayed(function)(*unit)
+                                                                                                for unit in workUnits)
+
+_PIPELINE_END = object()
+
+class _PipelineError:
+    def __init__(self, error):
+        self.error = error
+
+class StagedPipeline:
+    '''
+        Runs items through a chain of stages, every stage on its own pool of threads, linked by queues holding
+        at most {queueSize} items. A stage that falls behind fills the queue in front of it and holds back the
+        stages before it, so the throughput is set by the slowest stage instead of the sum of all of them.
+        Results are yielded in the order of the items, the ones completing early wait in a reorder buffer.
+        At most {maxInFlight} items are fed and not yet yielded, which bounds the buffer and the memory held.
+        The first error raised by a stage stops the pipeline and is raised to the consumer.
+        Per stage the number of items, the busy time and utilization of its workers and the depth of its
+        input queue are recorded, see stats.
+
+        Args:
+            stages: list of (name, function, workerCount) tuples, function is called with the output of the previous stage
+            queueSize: capacity of the queue in front of every stage
+            maxInFlight: maximum number of items in the pipeline, defaults to the capacity of the queues and workers
+    '''
+
+    def __init__(self, stages, queueSize=16, maxInFlight=None):
+        self.stages = [(name, function, max(1, workerCount)) for name, function, workerCount in stages]
+        self.queueSize = queueSize
+        self.maxInFlight = maxInFlight or sum(queueSize + workerCount for _, _, workerCount in self.stages)
+        self._stats = OrderedDict((name, {"workers": workerCount, "items": 0, "busySeconds": 0.0,
+                                          "queueDepthSum": 0, "queueDepthMax": 0})
+                                  for name, _, workerCount in self.stages)
+        self._reorderMax = 0
+        self._seconds = 0.0
+        self._runStart = None
+        self._lock = threading.Lock()
+
+    def run(self, items):
+        '''
+            Feeds {items} through the stages and yields the output of the last stage for every item, in item order.
+        '''
+        queues = [queue.Queue(self.queueSize) for _ in self.stages]
+        output = queue.Queue()
+        inFlight = threading.Semaphore(self.maxInFlight)
+        stopped = threading.Event()
+        remaining = [workerCount for _, _, workerCount in self.stages]
+
+        def feed():
+            try:
+                for item in enumerate(items):
+                    inFlight.acquire()
+                    if stopped.is_set():
+                        break
+                    queues[0].put(item)
+            except BaseException as error:
+                output.put(_PipelineError(error))
+            for _ in range(self.stages[0][2]):
+                queues[0].put(_PIPELINE_END)
+
+        def work(n, name, function):
+            stats = self._stats[name]
+            while True:
+                item = queues[n].get()
+                if item is _PIPELINE_END:
+                    break
+                depth = queues[n].qsize()
+                seq, value = item
+                start = time.perf_counter()
+                if not stopped.is_set():
+                    try:
+                        value = function(value)
+                    except BaseException as error:
+                        stopped.set()
+                        output.put(_PipelineError(error))
+                busySeconds = time.perf_counter() - start
+                with self._lock:
+                    stats["items"] += 1
+                    stats["busySeconds"] += busySeconds
+                    stats["queueDepthSum"] += depth
+                    stats["queueDepthMax"] = max(stats["queueDepthMax"], depth)
+                (queues[n + 1] if n + 1 < len(queues) else output).put((seq, value))
+
+            # the last worker of a stage to finish ends the next stage
+            with self._lock:
+                remaining[n] -= 1
+                last = remaining[n] == 0
+            if last:
+                if n + 1 < len(queues):
+                    for _ in range(self.stages[n + 1][2]):
+                        queues[n + 1].put(_PIPELINE_END)
+                else:
+                    output.put(_PIPELINE_END)
+
+        self._runStart = time.perf_counter()
+        threads = [threading.Thread(target=feed, daemon=True)]
+        for n, (name, function, workerCount) in enumerate(self.stages):
+            threads += [threading.Thread(target=work, args=(n, name, function), daemon=True) for _ in range(workerCount)]
+        for thread in threads:
+            thread.start()
+
+        reorder = {}
+        nextSeq = 0
+        try:
+            while True:
+                item = output.get()
+                if item is _PIPELINE_END:
+                    break
+                if isinstance(item, _PipelineError):
+                    raise item.error
+                reorder[item[0]] = item[1]
+                self._reorderMax = max(self._reorderMax, len(reorder))
+                while nextSeq in reorder:
+                    value = reorder.pop(nextSeq)
+                    nextSeq += 1
+                    inFlight.release()
+                    yield value
+        finally:
+            # a consumer stopping early or an error lets the threads drain the queues without running the stages
+            stopped.set()
+            inFlight.release()
+            self._seconds += time.perf_counter() - self._runStart
+            self._runStart = None
+
+    def stats(self):
+        '''
+            Returns per stage the number of items, the busy seconds of its workers, their utilization over the run time
+            and the mean and max depth of its input queue, plus the run time and the largest size of the reorder buffer.
+            A stage with a utilization close to 1 and a full queue in front of it is the bottleneck, give it more workers.
+        '''
+        # the run time includes a run still in progress, eg when the consumer did not read to the end
+        seconds = self._seconds + (time.perf_counter() - self._runStart if self._runStart is not None else 0.0)
+        with self._lock:
+            stages = OrderedDict()
+            for name, stats in self._stats.items():
+                stages[name] = {"workers": stats["workers"],
+                                "items": stats["items"],
+                                "busySeconds": round(stats["busySeconds"], 6),
+                                "utilization": round(stats["busySeconds"] / (seconds * stats["workers"]), 4) if seconds > 0 else None,
+                                "queueDepthMean": round(stats["queueDepthSum"] / stats["items"], 2) if stats["items"] else 0,
+                                "queueDepthMax": stats["queueDepthMax"]}
+            return {"seconds": round(seconds, 6), "queueSize": self.queueSize, "maxInFlight": self.maxInFlight,
+                    "reorderMax": self._reorderMax, "stages": stages}
+
+class DirectoryIndex:
     '''
-        Defines a function that returns a random color. The colors RGB values 
-        have constraint of {min} and {max}
+        Index of the files directly within {baseDir}, built with a single os.scandir pass and shared by
+        every pattern lookup, instead of listing the directory again for each glob.
+        The index is rebuilt when the modification time of the directory changes, ie when files are
+        added, removed or renamed. A directory modified within {racyWindow} seconds of the last scan is
+        rescanned on every lookup, as a change in the same timestamp tick would otherwise go unnoticed.
+        File sizes are recorded with the names so work can be balanced without stat calls per file.
 
         Args:
-            min: Min value for RGB
-            max: Max value for RGB
+             baseDir: directory to index
+             racyWindow: timestamp granularity of the file system, in seconds
     '''
-    return tuple([random.randint(min, max), random.randint(
-        min, max), random.randint(min, max)])
+
+    def __init__(self, baseDir, racyWindow=2.0):
+        self.baseDir = baseDir
+        self.racyWindow = racyWindow
+        self._mtime = None
+        self._scanTime = None
+        self._names = []
+        self._sizes = {}
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        '''
+            Rescans the directory if it changed since the last scan. A missing directory is indexed as empty.
+        '''
+        with self._lock:
+            try:
+                mtime = os.stat(self.baseDir).st_mtime
+            except FileNotFoundError:
+                mtime = None
+
+            if self._scanTime is not None and mtime == self._mtime and \
+                    (mtime is None or self._scanTime - mtime > self.racyWindow):
+                return
+
+            scanTime = time.time()
+            sizes = {}
+            if mtime is not None:
+                with os.scandir(self.baseDir) as entries:
+                    for entry in entries:
+                        if entry.is_file():
+                            sizes[entry.name] = entry.stat().st_size
+            self._names = sorted(sizes)
+            self._sizes = sizes
+            self._mtime = mtime
+            self._scanTime = scanTime
+
+    def find(self, searchString):
+        '''
+            Returns the paths of the files matching {searchString}, eg *.csv, in name order.
+            Like glob, wildcards do not match names starting with a dot unless the pattern does.
+        '''
+        self.refresh()
+        names, showHidden = self._names, searchString.startswith('.')
+        return [os.path.join(self.baseDir, name) for name in names
+                if fnmatch.fnmatch(name, searchString) and (showHidden or not name.startswith('.'))]
+
+    def size(self, path):
+        '''
+            Returns the size in bytes of the indexed file at {path}, or None when it is not in the index.
+        '''
+        self.refresh()
+        return self._sizes.get(path_leaf(path))
+
+# directory indexes of the current process, shared by all lookups
+_directoryIndexes = {}
+_directoryIndexesLock = threading.Lock()
+
+def get_directory_index(baseDir):
+    '''
+        Returns the DirectoryIndex of {baseDir} for the current process, creating it on first use.
+    '''
+    key = os.path.abspath(baseDir)
+    with _directoryIndexesLock:
+        if key not in _directoryIndexes:
+            _directoryIndexes[key] = DirectoryIndex(baseDir)
+        return _directoryIndexes[key]
 
 def findFile(baseDir, searchString):
     '''
         Helper function for finding files within {baseDir} that match {searchString}
         for example within c:\\input\\ap_metadata find *.csv
+        Lookups are served from the DirectoryIndex of {baseDir}, patterns spanning directories use glob.
 
         Args:
              baseDir: directory to look for the files within
              searchString: search pattern to use eg *.csv
     '''
-    strPath = os.path.join(baseDir, searchString)
-    print(f'looking in {baseDir} for {searchString}')
-    return [f for f in glob.glob(strPath)]
+    logger.debug(f'looking in {baseDir} for {searchString}')
+    if '/' in searchString or '\\' in searchString:
+        return [f for f in glob.glob(os.path.join(baseDir, searchString))]
+    return get_directory_index(baseDir).find(searchString)
 
 def find_base_images(baseDir):
     '''
@@ -108,6 +1352,25 @@ def find_base_images(baseDir):
     '''
     return findFile(baseDir, "*.png")
 
+def file_hash(path, blockSize=1024 * 1024):
+    '''
+        Helper function returning the sha1 hex digest of the content of the file at {path}.
+        Args:
+             path: file to hash
+             blockSize: number of bytes read at a time
+    '''
+    sha = hashlib.sha1()
+    with open(path, 'rb') as openFile:
+        for block in iter(lambda: openFile.read(blockSize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def content_hash(data):
+    '''
+        Helper function returning the sha1 hex digest of the bytes {data}, the digest file_hash returns for a file holding them.
+    '''
+    return hashlib.sha1(data).hexdigest()
+
 def path_leaf(path):
     '''
         Helper function to get FileName from path
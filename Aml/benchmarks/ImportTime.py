@@ -0,0 +1,99 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+# directory holding the stage modules, the imports are measured from there like AP runs them
+AML_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# module of every entry point: Prepare and Aggregate tasks, the training script and the estimator
+ENTRY_POINTS = ("PrepareDataset", "AggregateDataset", "train_model_pytorch", "Estimator")
+
+# dependencies that take long to import, none of them should be loaded by importing an entry point
+HEAVY_MODULES = ("pandas", "numpy", "PIL.Image", "joblib", "pyarrow", "torch", "torchvision", "facenet_pytorch", "azureml")
+
+
+def parse_importtime(stderr):
+    '''
+        Parses the -X importtime output of a python process into a dict of module name to
+        (self, cumulative) import time in microseconds.
+    '''
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        selfTime, cumulativeTime, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = (int(selfTime), int(cumulativeTime))
+    return modules
+
+
+def measure_import(module, python=sys.executable):
+    '''
+        Imports {module} in a fresh python process with -X importtime and returns the wall time of the process,
+        the cumulative import time of the module and the import times of every module loaded.
+    '''
+    start = time.perf_counter()
+    process = subprocess.run([python, '-X', 'importtime', '-c', f'import {module}'], cwd=AML_DIR,
+                             capture_output=True, text=True)
+    wallTime = time.perf_counter() - start
+    if process.returncode != 0:
+        raise RuntimeError(f"importing {module} failed: {process.stderr.splitlines()[-1:]}")
+
+    modules = parse_importtime(process.stderr)
+    return wallTime, modules[module][1] / 1e6, modules
+
+
+def benchmark_entry_point(module, repeat, top):
+    '''
+        Measures the import of {module} {repeat} times. Returns the median and minimum times, the heavy
+        dependencies the import loads and the {top} slowest modules by cumulative import time.
+    '''
+    wallTimes, importTimes = [], []
+    for _ in range(repeat):
+        wallTime, importTime, modules = measure_import(module)
+        wallTimes.append(wallTime)
+        importTimes.append(importTime)
+
+    slowest = sorted(((name, times[1]) for name, times in modules.items() if name != module),
+                     key=lambda item: item[1], reverse=True)[:top]
+    return {"importSeconds": {"median": round(statistics.median(importTimes), 4), "min": round(min(importTimes), 4)},
+            "processSeconds": {"median": round(statistics.median(wallTimes), 4), "min": round(min(wallTimes), 4)},
+            "heavyModulesLoaded": [name for name in HEAVY_MODULES if name in modules],
+            "slowestImports": [{"module": name, "seconds": round(us / 1e6, 4)} for name, us in slowest]}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Measures the import time of the entry points with python -X importtime')
+    parser.add_argument('--output', type=str, default='import_time_results.json', help='json file the results are written to')
+    parser.add_argument('--modules', type=str, default=','.join(ENTRY_POINTS), help='comma separated modules to measure')
+    parser.add_argument('--repeat', type=int, default=5, help='number of fresh processes per module')
+    parser.add_argument('--top', type=int, default=10, help='number of slowest imports reported per module')
+    return parser.parse_args()
+
+
+def main():
+    ''' Main method '''
+    args = parse_args()
+    entryPoints = {module: benchmark_entry_point(module, args.repeat, args.top) for module in args.modules.split(',')}
+
+    results = {"timestamp": datetime.now(timezone.utc).isoformat(),
+               "python": platform.python_version(),
+               "platform": platform.platform(),
+               "arguments": vars(args),
+               "entryPoints": entryPoints}
+    with open(args.output, 'w') as openFile:
+        json.dump(results, openFile, indent=2)
+
+    for module, result in entryPoints.items():
+        print(f'{module}: import {result["importSeconds"]["median"]}s, process {result["processSeconds"]["median"]}s, '
+              + f'heavy modules loaded: {result["heavyModulesLoaded"] or "none"}')
+    print(f'results written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
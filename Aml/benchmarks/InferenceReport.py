@@ -0,0 +1,256 @@
+import argparse
+import copy
+import glob
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from datetime import datetime, timezone
+import numpy as np
+from PIL import Image
+
+# the stages are flat modules in the parent directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from SyntheticDataset import make_overlay
+from Utils import nearest_neighbours
+import train_model_pytorch
+from train_model_pytorch import EMBEDDING_IMAGE_SIZE, inference_context, optimize_detector, optimize_embedder
+
+# inference modes compared, the first one is the current path the others are measured against
+MODES = (("eager", False, False), ("optimized", True, False), ("optimized_int8", True, True))
+
+
+def load_images(args):
+    '''
+        Returns the fixed image set as RGB PIL images: the first {args.images} images of {args.images_dir} by name,
+        or synthetic overlays on a gray background drawn with {args.seed} when no directory is given.
+        The synthetic images hold no faces and only give the latencies, the detection accuracy is only
+        meaningful when {args.images_dir} holds real face images.
+    '''
+    if args.images_dir:
+        paths = sorted(glob.glob(os.path.join(args.images_dir, '*.png')) + glob.glob(os.path.join(args.images_dir, '*.jpg')))
+        if not paths:
+            raise FileNotFoundError(f"Did not find any png or jpg images in {args.images_dir}")
+        return [Image.open(path).convert("RGB") for path in paths[:args.images]]
+
+    rng = np.random.default_rng(args.seed)
+    images = []
+    for _ in range(args.images):
+        background = Image.new("RGB", (args.width, args.height), (128, 128, 128))
+        overlay = Image.fromarray(make_overlay(rng, args.width // 2, args.height // 2), 'RGBA')
+        background.paste(overlay, (args.width // 4, args.height // 4), overlay)
+        images.append(background)
+    return images
+
+
+def face_boxes(images, batchBoxes):
+    '''
+        Returns the box the faces are cropped from for every image, the first detected box or the middle
+        of the image when nothing was detected, so every mode embeds the same crops.
+    '''
+    boxes = []
+    for img, detected in zip(images, batchBoxes):
+        width, height = img.size
+        boxes.append(detected[0] if detected is not None else np.array([width / 4, height / 4, width * 3 / 4, height * 3 / 4]))
+    return boxes
+
+
+def run_detector(mtcnn, images, batchSize, optimized):
+    '''
+        Runs {mtcnn} over {images} in batches of {batchSize} and returns the boxes, probabilities and
+        the detect latency per image of every batch.
+    '''
+    boxes, probs, latencies = [], [], []
+    for start in range(0, len(images), batchSize):
+        batch = images[start:start + batchSize]
+        detectStart = time.perf_counter()
+        with inference_context(optimized):
+            batchBoxes, batchProbs = mtcnn.detect(batch)
+        latencies.append((time.perf_counter() - detectStart) / len(batch))
+        boxes.extend(batchBoxes)
+        probs.extend(batchProbs)
+    return boxes, probs, latencies
+
+
+def run_embedder(model, crops, batchSize, optimized):
+    '''
+        Runs {model} over the standardized {crops} in batches of {batchSize} and returns the embeddings
+        and the embed latency per face of every batch.
+    '''
+    import torch
+
+    embeddings, latencies = [], []
+    for start in range(0, len(crops), batchSize):
+        batch = torch.stack(crops[start:start + batchSize])
+        embedStart = time.perf_counter()
+        with inference_context(optimized):
+            embeddings.append(model(batch).numpy())
+        latencies.append((time.perf_counter() - embedStart) / len(batch))
+    return np.concatenate(embeddings), latencies
+
+
+def latency_summary(latencies, warmup):
+    '''
+        Returns the median and p95 latency in milliseconds, leaving out the first {warmup} batches.
+    '''
+    measured = latencies[warmup:] or latencies
+    return {"p50": round(statistics.median(measured) * 1000, 3),
+            "p95": round(float(np.percentile(measured, 95)) * 1000, 3),
+            "batches": len(measured)}
+
+
+def box_iou(first, second):
+    '''
+        Returns the intersection over union of two (x1, y1, x2, y2) boxes.
+    '''
+    width = max(0.0, min(first[2], second[2]) - max(first[0], second[0]))
+    height = max(0.0, min(first[3], second[3]) - max(first[1], second[1]))
+    intersection = width * height
+    union = (first[2] - first[0]) * (first[3] - first[1]) + (second[2] - second[0]) * (second[3] - second[1]) - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+def detection_accuracy(reference, boxes, referenceProbs, probs):
+    '''
+        Compares the detections of a mode with the {reference} detections of the eager mode.
+        When no image was detected by both modes there is nothing to compare, sameDetectedFraction is None
+        instead of trivially 1.0 and a warning is returned with the comparison.
+    '''
+    sameDecision = [(first is None) == (second is None) for first, second in zip(reference, boxes)]
+    both = [(first, second, firstProbs, secondProbs)
+            for first, second, firstProbs, secondProbs in zip(reference, boxes, referenceProbs, probs)
+            if first is not None and second is not None]
+    if not both:
+        return {"sameDetectedFraction": None,
+                "imagesDetectedByBoth": 0,
+                "meanFirstBoxIoU": None,
+                "maxProbabilityDifference": None,
+                "warning": "no image was detected by both modes, use --images_dir with face images to compare the detections"}
+    return {"sameDetectedFraction": round(float(np.mean(sameDecision)), 4),
+            "imagesDetectedByBoth": len(both),
+            "meanFirstBoxIoU": round(float(np.mean([box_iou(first[0], second[0]) for first, second, _, _ in both])), 4),
+            "maxProbabilityDifference": float(max(abs(float(firstProbs[0]) - float(secondProbs[0])) for _, _, firstProbs, secondProbs in both))}
+
+
+def embedding_accuracy(reference, embeddings):
+    '''
+        Compares the embeddings of a mode with the {reference} embeddings of the eager mode: the cosine similarity
+        of the embeddings of the same face and the fraction of faces keeping their nearest neighbour.
+    '''
+    similarity = np.sum(reference * embeddings, axis=1) / (np.linalg.norm(reference, axis=1) * np.linalg.norm(embeddings, axis=1))
+    referenceNeighbours, _ = nearest_neighbours(reference, k=1)
+    neighbours, _ = nearest_neighbours(embeddings, k=1)
+    return {"minCosineSimilarity": round(float(similarity.min()), 6),
+            "meanCosineSimilarity": round(float(similarity.mean()), 6),
+            "sameNearestNeighbourFraction": round(float(np.mean(referenceNeighbours[:, 0] == neighbours[:, 0])), 4)}
+
+
+def build_models(args, optimized, quantize):
+    '''
+        Returns the detector and embedder of an inference mode, built from the same weights for every mode.
+    '''
+    import torch
+    facenet = train_model_pytorch.facenet
+
+    mtcnn = facenet.MTCNN(image_size=EMBEDDING_IMAGE_SIZE, margin=0, post_process=False)
+    if args.embedder_weights:
+        embedder = train_model_pytorch.load_face_embedder(args.embedder_weights)
+    else:
+        # random weights give the same latency, the accuracy report then only compares the modes with each other
+        torch.manual_seed(args.seed)
+        embedder = facenet.InceptionResnetV1().eval()
+
+    if optimized:
+        optimize_detector(mtcnn)
+        embedder = optimize_embedder(copy.deepcopy(embedder), quantize)
+    return mtcnn, embedder
+
+
+def run_report(args):
+    '''
+        Runs every inference mode over the fixed image set and returns the latency of each and its accuracy
+        relative to the eager mode.
+    '''
+    import torch
+    facenet = train_model_pytorch.facenet
+
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    images = load_images(args)
+
+    results, crops, reference = {}, None, None
+    for mode, optimized, quantize in MODES:
+        mtcnn, embedder = build_models(args, optimized, quantize)
+        # one pass before the measured ones, the first calls of a trace also optimize it
+        boxes, probs, detectLatencies = run_detector(mtcnn, images, args.batch, optimized)
+        boxes, probs, detectLatencies = run_detector(mtcnn, images, args.batch, optimized)
+        if crops is None:
+            # the faces are cropped from the eager detections, every mode embeds the same crops
+            crops = [facenet.fixed_image_standardization(facenet.extract_face(img, box, EMBEDDING_IMAGE_SIZE, 0))
+                     for img, box in zip(images, face_boxes(images, boxes))]
+        run_embedder(embedder, crops[:args.embed_batch], args.embed_batch, optimized)
+        embeddings, embedLatencies = run_embedder(embedder, crops, args.embed_batch, optimized)
+
+        result = {"detectMsPerImage": latency_summary(detectLatencies, args.warmup),
+                  "embedMsPerFace": latency_summary(embedLatencies, args.warmup),
+                  "imagesDetected": sum(box is not None for box in boxes)}
+        if reference is None:
+            reference = (boxes, probs, embeddings)
+        else:
+            result["detection"] = detection_accuracy(reference[0], boxes, reference[1], probs)
+            result["embedding"] = embedding_accuracy(reference[2], embeddings)
+            result["detectSpeedup"] = round(results["eager"]["detectMsPerImage"]["p50"] / result["detectMsPerImage"]["p50"], 3)
+            result["embedSpeedup"] = round(results["eager"]["embedMsPerFace"]["p50"] / result["embedMsPerFace"]["p50"], 3)
+        results[mode] = result
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Compares the accuracy and latency of the eager and optimized inference modes of eval')
+    parser.add_argument('--output', type=str, default='inference_report.json', help='json file the report is written to')
+    parser.add_argument('--images_dir', type=str, default=None, help='directory of png or jpg face images, required for a meaningful detection accuracy. '
+                        + 'synthetic images without faces by default, which only measure the latency')
+    parser.add_argument('--images', type=int, default=64, help='number of images')
+    parser.add_argument('--width', type=int, default=256, help='width of the synthetic images')
+    parser.add_argument('--height', type=int, default=256, help='height of the synthetic images')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the synthetic images and of the random embedder weights')
+    parser.add_argument('--embedder_weights', type=str, default=None, help='vggface2.pt weights of the embedder, random weights by default')
+    parser.add_argument('--threads', type=int, default=0, help='InferenceThreads, 0 keeps the torch default')
+    parser.add_argument('--batch', type=int, default=16, help='EvalBatchSize of the detector')
+    parser.add_argument('--embed_batch', type=int, default=32, help='EmbeddingBatchSize of the embedder')
+    parser.add_argument('--warmup', type=int, default=1, help='number of batches left out of the latencies')
+    return parser.parse_args()
+
+
+def main():
+    ''' Main method '''
+    args = parse_args()
+    modes = run_report(args)
+
+    import torch
+    results = {"timestamp": datetime.now(timezone.utc).isoformat(),
+               "python": platform.python_version(),
+               "torch": torch.__version__,
+               "platform": platform.platform(),
+               "threads": torch.get_num_threads(),
+               "arguments": vars(args),
+               "modes": modes}
+    with open(args.output, 'w') as openFile:
+        json.dump(results, openFile, indent=2)
+
+    for mode, result in modes.items():
+        line = f'{mode}: detect {result["detectMsPerImage"]["p50"]} ms/image, embed {result["embedMsPerFace"]["p50"]} ms/face'
+        if "embedding" in result:
+            line += (f', same detections {result["detection"]["sameDetectedFraction"]}'
+                     + f', min embedding cosine {result["embedding"]["minCosineSimilarity"]}')
+        print(line)
+        if "warning" in result.get("detection", {}):
+            print(f'WARNING {mode}: {result["detection"]["warning"]}')
+    print(f'report written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import types
+from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
+
+# the stages are flat modules in the parent directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from SyntheticDataset import generate_dataset
+from Utils import create_dir_if_not_Exist, read_from_json, ImageShardReader, DecodedImageCache, BackgroundWriterPool
+
+try:
+    import resource
+except ImportError:
+    # not available on windows, peak RSS is not reported there
+    resource = None
+
+STAGES = ("prepare", "eval", "aggregate")
+
+
+def peak_rss_mb():
+    '''
+        Returns the peak resident set size in MB of this process and of its finished child processes,
+        the pool workers of the processes backend. None when the resource module is not available.
+        The peak covers the whole benchmark run so far, not only the last stage.
+    '''
+    if resource is None:
+        return None
+    # ru_maxrss is in bytes on macOS and in KB elsewhere
+    unit = 1 if sys.platform == 'darwin' else 1024
+    selfPeak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit
+    childrenPeak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit
+    return {"self": round(selfPeak / 2 ** 20, 1), "children": round(childrenPeak / 2 ** 20, 1)}
+
+
+def stage_result(seconds, images, **extra):
+    '''
+        Returns the result record of a stage that processed {images} images in {seconds}.
+    '''
+    result = {"seconds": round(seconds, 3), "images": images,
+              "imagesPerSec": round(images / seconds, 2) if seconds > 0 else None,
+              "peakRssMB": peak_rss_mb()}
+    result.update(extra)
+    return result
+
+
+class StubDetector:
+    '''
+        Stand-in for MTCNN with the same detect interface, returning one fixed face box in the middle
+        of every image so eval can be measured without the cost of the detector.
+    '''
+
+    def __init__(self, image_size=160, margin=0):
+        self.image_size = image_size
+        self.margin = margin
+
+    def detect(self, imgs, landmarks=False):
+        boxes, probs, points = [], [], []
+        for img in imgs:
+            width, height = img.size
+            box = np.array([[width / 4, height / 4, width * 3 / 4, height * 3 / 4]])
+            boxes.append(box)
+            probs.append(np.array([0.99]))
+            points.append(np.tile(box[:, None, :2], (1, 5, 1)))
+        if landmarks:
+            return boxes, probs, points
+        return boxes, probs
+
+
+def benchmark_prepare(args, dataDir, resultDir):
+    '''
+        Runs StartPrepare on the synthetic dataset in {dataDir} and returns its stage result.
+    '''
+    import PrepareDataset
+
+    config = read_from_json(args.prepare_config)
+    config.update({"ImageSampleCount": str(args.samples), "BackgroundPerImage": str(args.backgrounds),
+                   "ExecutorBackend": args.backend, "WorkerCount": str(args.workers), "OutputFormat": args.output_format,
+                   "Seed": str(args.seed)})
+    configPath = os.path.join(os.path.dirname(resultDir), 'prepare.benchmark.config')
+    with open(configPath, 'w') as openFile:
+        json.dump(config, openFile)
+
+    inputData = types.SimpleNamespace(dataDir=dataDir, toolsDir=None, scriptConfig=configPath, resultDir=resultDir)
+    start = time.perf_counter()
+    PrepareDataset.StartPrepare(inputData)
+    seconds = time.perf_counter() - start
+    return stage_result(seconds, args.samples * args.backgrounds, sourceImages=args.images)
+
+
+def prepared_table(resultDir, uuid):
+    '''
+        Returns the output table written by Prepare to {resultDir}. Prepare builds its paths with a backslash
+        separator, the same literal path is used here so the table is found on any platform.
+    '''
+    return pd.read_csv(f'{resultDir}\\AP_Metadata\\{uuid}.outputTable.metadata.csv')
+
+
+def benchmark_eval(args, resultDir, uuid, evalDir):
+    '''
+        Runs run_eval over the images generated by Prepare in {resultDir} and returns its stage result.
+    '''
+    import train_model_pytorch
+
+    images = prepared_table(resultDir, uuid)
+    shardReader = ImageShardReader(resultDir) if args.output_format == 'tar' else None
+    if shardReader is None and os.sep != '\\':
+        # Prepare saves the images as {resultDir}\{NewImage}, outside of resultDir on other platforms.
+        # move them to where eval looks for them, before the timing starts
+        create_dir_if_not_Exist(resultDir)
+        for name in images["NewImage"]:
+            if os.path.exists(f'{resultDir}\\{name}'):
+                os.replace(f'{resultDir}\\{name}', os.path.join(resultDir, name))
+
+    if args.detector == 'mtcnn':
+        from facenet_pytorch import MTCNN
+        detector = MTCNN(image_size=160, margin=0, post_process=False)
+    else:
+        detector = StubDetector()
+
+    create_dir_if_not_Exist(evalDir)
+    extra = {"detector": args.detector}
+    decodedCache = None
+    if args.decoded_cache:
+        # the cache is filled before the timing starts, eval then measures reading from the memory map
+        decodedCache = DecodedImageCache(os.path.join(evalDir, uuid))
+        start = time.perf_counter()
+        train_model_pytorch.fill_decoded_cache(images, resultDir, decodedCache, shardReader, args.loader_workers, 4)
+        extra["decodedCacheSeconds"] = round(time.perf_counter() - start, 3)
+
+    cropWriter = BackgroundWriterPool(args.crop_writers, 64) if args.crop_writers > 0 else None
+    start = time.perf_counter()
+    rows = sum(1 for _ in train_model_pytorch.run_eval(images, resultDir, detector, evalDir, shardReader, args.eval_batch,
+                                                       args.loader_workers, 4, cropWriter, decodedCache=decodedCache))
+    if cropWriter is not None:
+        cropWriter.close()
+    seconds = time.perf_counter() - start
+    if shardReader is not None:
+        shardReader.close()
+    if decodedCache is not None:
+        decodedCache.close()
+    return stage_result(seconds, rows, **extra)
+
+
+def benchmark_aggregate(args, resultDir, uuid, aggregateDir):
+    '''
+        Writes {args.clips} copies of the Prepare output table, each as the table of a different clip,
+        and runs StartAggregate over them. Returns its stage result.
+    '''
+    import AggregateDataset
+
+    table = prepared_table(resultDir, uuid)
+    schemaFile = os.path.join(f'{resultDir}\\AP_Metadata', f'{uuid}.outputTable.metadata.schema.md')
+    clipsDir = os.path.join(aggregateDir, 'clips')
+    for clip in range(args.clips):
+        clipUuid = f'{uuid}-{clip:05d}'
+        clipDir = os.path.join(clipsDir, clipUuid)
+        create_dir_if_not_Exist(clipDir)
+        table.assign(ClipUuid=clipUuid).to_csv(os.path.join(clipDir, f'{clipUuid}.outputTable.metadata.csv'), index=False)
+        shutil.copy(schemaFile, os.path.join(clipDir, f'{clipUuid}.outputTable.metadata.schema.md'))
+
+    configPath = os.path.join(aggregateDir, 'aggregate.benchmark.config')
+    with open(configPath, 'w') as openFile:
+        json.dump({"WorkerCount": str(args.workers)}, openFile)
+
+    inputData = types.SimpleNamespace(dataDir=clipsDir, toolsDir=None, scriptConfig=configPath,
+                                      resultDir=os.path.join(aggregateDir, 'result'))
+    start = time.perf_counter()
+    AggregateDataset.StartAggregate(inputData)
+    seconds = time.perf_counter() - start
+    return stage_result(seconds, len(table) * args.clips, clips=args.clips)
+
+
+def run_benchmarks(args, workDir):
+    '''
+        Generates the synthetic dataset in {workDir} and runs the selected stages on it.
+        eval and aggregate consume the output of prepare, which always runs.
+    '''
+    dataDir = os.path.join(workDir, 'data')
+    resultDir = os.path.join(workDir, 'prepare')
+
+    start = time.perf_counter()
+    uuid = generate_dataset(dataDir, args.images, args.width, args.height, args.seed)
+    results = {"generate": stage_result(time.perf_counter() - start, args.images)}
+
+    stages = args.stages.split(',')
+    results["prepare"] = benchmark_prepare(args, dataDir, resultDir)
+    if "eval" in stages:
+        results["eval"] = benchmark_eval(args, resultDir, uuid, os.path.join(workDir, 'eval'))
+    if "aggregate" in stages:
+        results["aggregate"] = benchmark_aggregate(args, resultDir, uuid, os.path.join(workDir, 'aggregate'))
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmarks the Prepare, eval and aggregate stages on a synthetic dataset')
+    parser.add_argument('--output', type=str, default='benchmark_results.json', help='json file the results are written to')
+    parser.add_argument('--stages', type=str, default=','.join(STAGES), help='comma separated stages to run')
+    parser.add_argument('--work_dir', type=str, default=None, help='directory for the dataset and outputs, a temporary one by default')
+    parser.add_argument('--keep', action='store_true', help='keep the work directory')
+    parser.add_argument('--images', type=int, default=200, help='number of synthetic overlays')
+    parser.add_argument('--width', type=int, default=256, help='width of the overlays')
+    parser.add_argument('--height', type=int, default=256, help='height of the overlays')
+    parser.add_argument('--samples', type=int, default=400, help='ImageSampleCount of Prepare')
+    parser.add_argument('--backgrounds', type=int, default=2, help='BackgroundPerImage of Prepare')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the dataset and of Prepare')
+    parser.add_argument('--prepare_config', type=str,
+                        default=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'prepare.config'),
+                        help='prepare.config the benchmark settings are applied to')
+    parser.add_argument('--backend', type=str, default='processes', help='ExecutorBackend of Prepare')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='WorkerCount of Prepare and aggregate')
+    parser.add_argument('--output_format', type=str, default='files', help='OutputFormat of Prepare, files or tar')
+    parser.add_argument('--detector', type=str, default='stub', help='stub or mtcnn')
+    parser.add_argument('--eval_batch', type=int, default=16, help='EvalBatchSize of eval')
+    parser.add_argument('--loader_workers', type=int, default=2, help='LoaderWorkers of eval')
+    parser.add_argument('--decoded_cache', action='store_true', help='decode the images into a DecodedImageCache before timing eval')
+    parser.add_argument('--crop_writers', type=int, default=4, help='CropWriterThreads of eval, 0 skips the crops')
+    parser.add_argument('--clips', type=int, default=50, help='number of clip tables merged by aggregate')
+    return parser.parse_args()
+
+
+def main():
+    ''' Main method '''
+    args = parse_args()
+    workDir = args.work_dir or tempfile.mkdtemp(prefix='ap_benchmark')
+    if os.path.exists(os.path.join(workDir, 'data')):
+        raise FileExistsError(f"{workDir} already holds a benchmark run, use an empty work directory")
+
+    try:
+        stages = run_benchmarks(args, workDir)
+    finally:
+        if not args.keep:
+            shutil.rmtree(workDir, ignore_errors=True)
+
+    results = {"timestamp": datetime.now(timezone.utc).isoformat(),
+               "python": platform.python_version(),
+               "platform": platform.platform(),
+               "cpuCount": os.cpu_count(),
+               "arguments": vars(args),
+               "stages": stages}
+    with open(args.output, 'w') as openFile:
+        json.dump(results, openFile, indent=2)
+
+    for stage, result in stages.items():
+        print(f'{stage}: {result["seconds"]}s, {result["imagesPerSec"]} images/s, peak RSS {result["peakRssMB"]} MB')
+    print(f'results written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
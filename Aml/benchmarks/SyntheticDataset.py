@@ -0,0 +1,78 @@
+import argparse
+import os
+import sys
+import uuid as uuidlib
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+# the stages are flat modules in the parent directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Utils import create_dir_if_not_Exist
+
+SCHEMA = "## name\n`string`\n\n## Score\n`float?`\n\n## IsLabeled\n`bool`\n\n## FaceRect\n`RectF?`\n\n"
+
+
+def make_overlay(rng, width, height):
+    '''
+        Defines a method that draws a synthetic RGBA overlay of {width} x {height}: a noisy colored ellipse,
+        opaque in the middle and fading out to fully transparent at the border, roughly like a cut out face.
+    '''
+    y, x = np.mgrid[0:height, 0:width]
+    distance = np.sqrt(((x - width / 2) / (width / 2)) ** 2 + ((y - height / 2) / (height / 2)) ** 2)
+    alpha = np.clip((1.0 - distance) * 2.0, 0.0, 1.0) * 255
+
+    color = rng.integers(0, 256, 3)
+    noise = rng.integers(-40, 41, (height, width, 3))
+    rgb = np.clip(color + noise, 0, 255)
+    return np.dstack([rgb, alpha]).astype(np.uint8)
+
+
+def generate_dataset(outputDir, imageCount, width=256, height=256, seed=0, uuid=None):
+    '''
+        Defines a method that writes a synthetic AP dataset to {outputDir}: {imageCount} RGBA overlay pngs,
+        the {uuid}.csv aptable with one row per png and its {uuid}.schema.md, as staged for the Prepare stage.
+
+        Args:
+            outputDir: directory to write the dataset to
+            imageCount: number of overlay pngs
+            width: width of the overlays
+            height: height of the overlays
+            seed: random seed, the same seed writes the same dataset
+            uuid: uuid of the aptable, a random one by default
+        Returns:
+            the uuid of the aptable
+    '''
+    create_dir_if_not_Exist(outputDir)
+    uuid = uuid or str(uuidlib.uuid4())
+    rng = np.random.default_rng(seed)
+
+    names = [f'overlay{i:06d}' for i in range(imageCount)]
+    for name in names:
+        Image.fromarray(make_overlay(rng, width, height), 'RGBA').save(os.path.join(outputDir, f'{name}.png'))
+
+    table = pd.DataFrame({'name': names,
+                          'Score': rng.random(imageCount).round(4),
+                          'IsLabeled': rng.random(imageCount) < 0.5,
+                          'FaceRect': [f'({width // 4}, {height // 4}, {width // 2}, {height // 2})'] * imageCount})
+    table.to_csv(os.path.join(outputDir, f'{uuid}.csv'), index=False)
+    with open(os.path.join(outputDir, f'{uuid}.schema.md'), 'w') as openFile:
+        openFile.write(SCHEMA)
+    return uuid
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Writes a synthetic AP dataset for the Prepare stage')
+    parser.add_argument('--output_dir', type=str, required=True, help='directory to write the dataset to')
+    parser.add_argument('--images', type=int, default=200, help='number of overlay pngs')
+    parser.add_argument('--width', type=int, default=256, help='width of the overlays')
+    parser.add_argument('--height', type=int, default=256, help='height of the overlays')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    uuid = generate_dataset(args.output_dir, args.images, args.width, args.height, args.seed)
+    print(f'wrote {args.images} overlays and aptable {uuid} to {args.output_dir}')
@@ -0,0 +1,7 @@
+'''
+    Offline benchmarks of the Prepare, eval and aggregate stages on a synthetic AP dataset.
+    Run RunBenchmarks.py for stage throughput, ImportTime.py for the start up cost of the entry points
+    and InferenceReport.py for the accuracy and latency of the eval inference modes, see their --help.
+    No clips or AzureML workspace are needed. InferenceReport only compares the detections when
+    --images_dir points at real face images, the synthetic images hold no faces.
+'''
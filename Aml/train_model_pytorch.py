@@ -1,17 +1,39 @@
 import argparse
-import pandas as pd
-from functools import reduce
-import torch
-from torch.utils.data import DataLoader
-from torchvision import datasets
+from itertools import chain
 import os
-import numpy as np
-from azureml.core.run import Run
-from facenet_pytorch import MTCNN, InceptionResnetV1,  extract_face
-from PIL import Image, ImageDraw
-from Utils import read_from_json, create_dir_if_not_Exist, read_input_meta_table, write_output_schema, BOOLEAN_SCHEMA_TEMPLATE, FLOATNULLABLE_SCHEMA_TEMPLATE, RECTFNULLABLE_SCHEMA_TEMPLATE
+from Utils import read_from_json, create_dir_if_not_Exist, read_input_meta_table, load_meta_table, write_output_schema, ResultTableBuilder, StreamingTableWriter, ImageShardReader, DecodedImageCache, BackgroundWriterPool, MetricsBuffer, get_run_context, StageMetrics, create_embedding_matrix, similar_pairs, configure_logging, lazy_import, BOOLEAN_SCHEMA_TEMPLATE, FLOATNULLABLE_SCHEMA_TEMPLATE, RECTFNULLABLE_SCHEMA_TEMPLATE
 import json
 import shutil
+import io
+import inspect
+from collections import OrderedDict
+from array import array
+import logging
+import sys
+import time
+
+# torch and facenet_pytorch take seconds to import, they are imported on first use like the other
+# heavy dependencies so arguments and config are checked right away, see lazy_import
+pd = lazy_import("pandas")
+np = lazy_import("numpy")
+Image = lazy_import("PIL.Image")
+facenet = lazy_import("facenet_pytorch")
+
+logger = logging.getLogger(__name__)
+
+# columns eval adds to the output table and their dtypes
+EVAL_COLUMNS = [('FaceDetected', bool),
+                ('X', 'float64'),
+                ('Y', 'float64'),
+                ('Width', 'float64'),
+                ('Height', 'float64'),
+                ('confidence', 'float64'),
+                ('dtImageName', object),
+                ('landmarks', object)]
+
+# InceptionResnetV1 is trained on 160x160 face crops and returns 512 values per face
+EMBEDDING_IMAGE_SIZE = 160
+EMBEDDING_DIMENSION = 512
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -28,29 +50,344 @@ def parse_args():
     return parser.parse_args()
 
 
-def run_training(images, inputdir, logSampleRage):
+def run_training(images, inputdir, logSampleRage, run=None, metricsFlushSize=250):
+    '''
+    Defines method that runs training on the given images and logs the training metrics of a sample of them.
+    Metrics are buffered and sent in batches, see MetricsBuffer.
 
+    Args:
+        images: data frame with the training images
+        inputdir: directory containing the images
+        logSampleRage: a row's metrics are logged when a random draw is above this rate
+        run: run to log to, defaults to get_run_context()
+        metricsFlushSize: number of values of a metric sent per logging call
+    Returns:
+        summary statistics of the logged metrics
+    '''
     preTrainedModel = os.path.join("pretrainedModel", "vggface2.pt")
     exists = os.path.exists(preTrainedModel)
-    print(f'preTrainedModel {preTrainedModel} exists: {exists}')
+    logger.info(f'preTrainedModel {preTrainedModel} exists: {exists}')
     outputsModel =  os.path.join("outputs", "vggface2.pt")
     shutil.copy(preTrainedModel, outputsModel)
-    run = Run.get_context()
-    for i, row in images.iterrows():
-        if np.random.rand() > logSampleRage:
-            run.log("Image", i)
-            run.log("fps", np.random.rand())
-            run.log("accuracy", np.random.rand())
-            run.log("confidence", np.random.rand())
+    if run is None:
+        run = get_run_context()
+
+    # draw the sample for all rows at once, the metric values of the sampled rows are added as arrays
+    sampled = np.random.rand(len(images)) > logSampleRage
+    sampleCount = int(sampled.sum())
+    metrics = MetricsBuffer(run, metricsFlushSize)
+    metrics.extend("Image", images.index.values[sampled])
+    metrics.extend("fps", np.random.rand(sampleCount))
+    metrics.extend("accuracy", np.random.rand(sampleCount))
+    metrics.extend("confidence", np.random.rand(sampleCount))
+
+    stats = metrics.close()
+    logger.info(f'training metrics: {stats}')
+    return stats
+
+
+def open_eval_image(inputdir, imageName, shardReader=None):
+    '''
+        Opens image {imageName} from the tar shards of {shardReader} when it was packed by prepare,
+        otherwise from its own file in {inputdir}.
+    '''
+    if shardReader is not None and imageName in shardReader:
+        return Image.open(io.BytesIO(shardReader.read(imageName)))
+    return Image.open(os.path.join(inputdir, imageName))
+
+class EvalImageDataset:
+    '''
+    Map style dataset over the evaluation images, used with a DataLoader so the images are decoded
+    by worker processes while the detector runs.
+    Each item is (index, imageName, pixels) where index is the label of the image row in {images}
+    and pixels the decoded RGB image as a uint8 array, which is cheaper to send back from a worker than a PIL image.
+    Images held by {decodedCache} are read from its memory map instead of being decoded.
+
+    Args:
+        images: data frame with the NewImage names within inputdir to use
+        inputdir: directory containing the images specified by images
+        shardReader: ImageShardReader for images packed into tar shards
+        decodedCache: DecodedImageCache with images decoded by an earlier pass
+    '''
+
+    def __init__(self, images, inputdir, shardReader=None, decodedCache=None):
+        self.indices = images.index.tolist()
+        self.names = images["NewImage"].tolist()
+        self.inputdir = inputdir
+        self.shardReader = shardReader
+        self.decodedCache = decodedCache
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, n):
+        imageName = self.names[n]
+        if self.decodedCache is not None and imageName in self.decodedCache:
+            return self.indices[n], imageName, self.decodedCache.read(imageName)
+        with open_eval_image(self.inputdir, imageName, self.shardReader) as img:
+            pixels = np.asarray(img.convert("RGB"))
+        return self.indices[n], imageName, pixels
+
+def keep_sample(sample):
+    '''
+    Collate function for the eval DataLoader that hands samples through unchanged.
+    '''
+    return sample
+
+def load_eval_images(images, inputdir, shardReader=None, loaderWorkers=0, prefetchDepth=2, decodedCache=None):
+    '''
+    Defines method that decodes the given images in {loaderWorkers} background processes, each keeping
+    up to {prefetchDepth} images decoded ahead of the detector. Images are returned in the order of {images}.
+    When {decodedCache} holds all the images they are read from it on the calling thread, a worker would
+    have to copy the pixels to send them back.
+
+    Args:
+        images: data frame with the NewImage names within inputdir to use
+        inputdir: directory containing the images specified by images
+        shardReader: ImageShardReader for images packed into tar shards
+        loaderWorkers: number of decode processes, 0 decodes on the calling thread
+        prefetchDepth: number of images decoded ahead per worker, ignored before torch 1.7
+        decodedCache: DecodedImageCache with images decoded by an earlier pass
+    Returns:
+        iterable of (index, imageName, pixels) tuples, see EvalImageDataset
+    '''
+    from torch.utils.data import DataLoader
+
+    if decodedCache is not None and all(name in decodedCache for name in images["NewImage"]):
+        loaderWorkers = 0
+
+    # prefetch_factor was added in torch 1.7, older versions keep their fixed depth of 2 images per worker
+    loaderOptions = {"num_workers": loaderWorkers}
+    if loaderWorkers > 0 and "prefetch_factor" in inspect.signature(DataLoader).parameters:
+        loaderOptions["prefetch_factor"] = prefetchDepth
+
+    # batch_size=None hands out single samples, batching by resolution happens in iter_eval_batches
+    return DataLoader(EvalImageDataset(images, inputdir, shardReader, decodedCache), batch_size=None, shuffle=False,
+                      collate_fn=keep_sample, **loaderOptions)
+
+def fill_decoded_cache(images, inputdir, decodedCache, shardReader=None, loaderWorkers=0, prefetchDepth=2):
+    '''
+    Defines method that decodes the given images missing from {decodedCache} and adds them to it,
+    so every later eval pass over them reads their pixels from the cache instead of decoding them.
+    Images are decoded by {loaderWorkers} background processes, see load_eval_images.
+
+    Args:
+        images: data frame with the NewImage names within inputdir to use
+        inputdir: directory containing the images specified by images
+        decodedCache: DecodedImageCache the images are added to
+        shardReader: ImageShardReader for images packed into tar shards
+        loaderWorkers: number of decode processes, 0 decodes on the calling thread
+        prefetchDepth: number of images decoded ahead per worker
+    Returns:
+        number of images added
+    '''
+    missing = images.loc[~images["NewImage"].isin(list(decodedCache.locations))]
+    missing = missing.drop_duplicates("NewImage")
+    for _, imageName, pixels in load_eval_images(missing, inputdir, shardReader, loaderWorkers, prefetchDepth):
+        decodedCache.add(imageName, pixels)
+    return len(missing)
+
+def iter_eval_batches(samples, batchSize):
+    '''
+    Defines method that groups decoded images into batches of up to {batchSize} images
+    sharing the same resolution, so each batch can be stacked into a single detector call.
+    Images are bucketed by resolution as they arrive, a bucket is yielded as soon as it is full
+    and the partially filled buckets once all images are read.
+
+    Args:
+        samples: iterable of (index, imageName, pixels) tuples, see load_eval_images
+        batchSize: maximum number of images per batch
+    Yields:
+        lists of (index, imageName, img) tuples
+    '''
+    buckets = OrderedDict()
+    for i, imageName, pixels in samples:
+        img = Image.fromarray(pixels)
+        bucket = buckets.setdefault(img.size, [])
+        bucket.append((i, imageName, img))
+        if len(bucket) >= batchSize:
+            yield buckets.pop(img.size)
+
+    for bucket in buckets.values():
+        yield bucket
+
+def load_face_embedder(modelPath):
+    '''
+    Defines method that loads InceptionResnetV1 with the weights in {modelPath}, eg the shipped vggface2.pt,
+    set up to return the normalized face embeddings. The classifier weights of the file are not used.
+    '''
+    import torch
+
+    state = torch.load(modelPath, map_location='cpu')
+    state = {name: value for name, value in state.items() if not name.startswith('logits.')}
+    model = facenet.InceptionResnetV1()
+    model.load_state_dict(state)
+    return model.eval()
+
+def inference_context(optimized=False):
+    '''
+    Returns the context the models are run in, torch.inference_mode in the optimized inference mode
+    when torch has it, which also skips the version counting of no_grad, otherwise torch.no_grad.
+    '''
+    import torch
+
+    if optimized and hasattr(torch, 'inference_mode'):
+        return torch.inference_mode()
+    return torch.no_grad()
+
+def configure_inference_threads(threadCount):
+    '''
+    Defines method that sets the number of threads torch runs a single operation on, 0 keeps the default of torch.
+    '''
+    import torch
+
+    if threadCount > 0:
+        torch.set_num_threads(threadCount)
+    logger.info(f'torch runs operations on {torch.get_num_threads()} threads')
+
+def optimize_detector(mtcnn):
+    '''
+    Defines method that replaces the three networks of {mtcnn} with TorchScript traces, run without the
+    python overhead of the eager modules. The networks are fully convolutional or flatten each image on its own,
+    so one trace serves every image size and batch size. Traces keep their parameters, detect reads their dtype.
+    '''
+    import torch
+
+    mtcnn.eval()
+    with torch.no_grad():
+        mtcnn.pnet = torch.jit.trace(mtcnn.pnet, torch.rand(1, 3, 48, 48))
+        mtcnn.rnet = torch.jit.trace(mtcnn.rnet, torch.rand(2, 3, 24, 24))
+        mtcnn.onet = torch.jit.trace(mtcnn.onet, torch.rand(2, 3, 48, 48))
+    return mtcnn
+
+def optimize_embedder(model, quantize=False):
+    '''
+    Defines method that returns a TorchScript trace of the embedder {model}. With {quantize} its linear layer
+    is first converted to dynamic int8 quantization, the embeddings then differ slightly from the fp32 model,
+    see benchmarks/InferenceReport.py.
+    '''
+    import torch
+
+    if quantize:
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    with torch.no_grad():
+        return torch.jit.trace(model, torch.rand(2, 3, EMBEDDING_IMAGE_SIZE, EMBEDDING_IMAGE_SIZE))
+
+class FaceEmbedder:
+    '''
+    Collects the faces detected during eval and runs them through {model} in batches of {batchSize} crops.
+    Every evaluated image is added in the order its row is written to the output table, the embedding
+    of its face is written to the same row of {embeddings}, rows of images without a face stay NaN.
+    Faces are cropped to EMBEDDING_IMAGE_SIZE and standardized the way the model was trained.
+
+    Args:
+        model: InceptionResnetV1 in eval mode, see load_face_embedder
+        embeddings: (rows, EMBEDDING_DIMENSION) matrix aligned to the output table, see create_embedding_matrix
+        batchSize: number of crops embedded at once
+        margin: margin in pixels added around the detected box, see extract_face
+        metrics: StageMetrics the embed latency per face is recorded in
+        optimizedInference: run the model in the optimized inference mode, see inference_context
+    '''
+
+    def __init__(self, model, embeddings, batchSize=32, margin=0, metrics=None, optimizedInference=False):
+        self.model = model
+        self.optimizedInference = optimizedInference
+        self.embeddings = embeddings
+        self.batchSize = batchSize
+        self.margin = margin
+        self.metrics = metrics or StageMetrics("eval", "OFF")
+        self.names = []
+        self.embedded = 0
+        self._pending = []
 
+    def add(self, imageName, img, box=None):
+        '''
+        Adds image {imageName} as the next output table row, with the face in {box} of {img}, None when no face was found.
+        '''
+        row = len(self.names)
+        self.names.append(imageName)
+        if box is None:
+            return
+        crop = facenet.extract_face(img, box, EMBEDDING_IMAGE_SIZE, self.margin)
+        self._pending.append((row, crop))
+        if len(self._pending) >= self.batchSize:
+            self.flush()
 
-def run_eval(images, inputdir, mtcnn, outputDir):
+    def flush(self):
+        '''
+        Embeds the faces added since the last flush.
+        '''
+        if not self._pending:
+            return
+        import torch
+
+        rows, crops = zip(*self._pending)
+        self._pending = []
+        embedStart = time.perf_counter()
+        with inference_context(self.optimizedInference):
+            batch = self.model(facenet.fixed_image_standardization(torch.stack(crops)))
+        self.embeddings[list(rows)] = batch.numpy()
+        if self.metrics.histogramsEnabled:
+            embedSeconds = (time.perf_counter() - embedStart) / len(rows)
+            for _ in rows:
+                self.metrics.observe("embed", embedSeconds)
+        self.metrics.count("faces_embedded", len(rows))
+        self.embedded += len(rows)
+
+def write_similar_pairs(embeddings, names, threshold, path):
+    '''
+    Defines method that writes the pairs of images whose face embeddings have a cosine similarity of at least
+    {threshold} to the csv file {path}, the near duplicates and faces of the same identity among the images.
+
+    Args:
+        embeddings: (rows, EMBEDDING_DIMENSION) matrix aligned to the output table
+        names: NewImage names of the output table rows
+        threshold: minimum cosine similarity of a pair
+        path: csv file to write
+    Returns:
+        number of pairs written
+    '''
+    first, second, similarity = similar_pairs(embeddings, threshold)
+    names = np.asarray(names, dtype=object)
+    pd.DataFrame({'NewImage': names[first], 'SimilarImage': names[second],
+                  'Similarity': similarity}).to_csv(path, index=False)
+    return len(first)
+
+def save_crop(crop, path, cropFormat, compressLevel):
+    '''
+    Defines method that encodes a face crop returned by extract_face and writes it to {path}.
+    Runs on the crop writer pool.
+
+    Args:
+        crop: float tensor (3, H, W) holding 0-255 pixel values
+        path: file to write
+        cropFormat: PIL format name, eg PNG or JPEG
+        compressLevel: zlib level 0-9 for PNG, quality 1-100 for lossy formats
+    '''
+    face = Image.fromarray(np.uint8(crop.permute(1, 2, 0).numpy()))
+    if cropFormat.upper() == "PNG":
+        face.save(path, cropFormat, compress_level=compressLevel)
+    else:
+        face.save(path, cropFormat, quality=compressLevel)
+
+def crop_file_name(imageName, cropFormat):
+    '''
+    Returns the name of the face crop file for {imageName} written in {cropFormat}.
+    '''
+    extension = {"JPEG": "jpg"}.get(cropFormat.upper(), cropFormat.lower())
+    return f'detected_face_{os.path.splitext(imageName)[0]}.{extension}'
+
+def run_eval(images, inputdir, mtcnn, outputDir, shardReader=None, batchSize=1, loaderWorkers=0, prefetchDepth=2,
+             cropWriter=None, cropFormat="PNG", compressLevel=6, metrics=None, decodedCache=None, embedder=None,
+             optimizedInference=False):
     '''
     Defines method will on the given images within input directory run
     through the provided mtcnn detector to run find a face on the image.
-    The function will return the row from the original data frame table that has all metadata about the image
+    The function will return the index of the row from the original data frame table that has all metadata about the image
     along with information for the bounding box for the face detected (if any), the probability
     and the file generated by the mtcnn.
+    Detection runs once per image on batches of images with the same resolution, the saved face crop
+    and the box, probability and landmarks are all taken from that single result.
 
     Args:
         inputData:
@@ -58,79 +395,254 @@ def run_eval(images, inputdir, mtcnn, outputDir):
             inputdir: directory containing the images specified by images
             mtcnn: MTCNN to use to run face detection
             outputDir: directory to save output of MTCNN in.
+            shardReader: ImageShardReader for images packed into tar shards, images are then read in shard order.
+            batchSize: maximum number of images passed to the detector at once.
+            loaderWorkers: number of processes decoding images ahead of the detector, see load_eval_images.
+            prefetchDepth: number of images each loader process decodes ahead.
+            cropWriter: BackgroundWriterPool the face crops are encoded and written on, None skips writing crops.
+            cropFormat: format the face crops are written in, see save_crop.
+            compressLevel: compression level of the face crops, see save_crop.
+            metrics: StageMetrics the time waiting for decoded images and the detect latency per image are recorded in.
+            decodedCache: DecodedImageCache the images are read from instead of being decoded, see fill_decoded_cache.
+            embedder: FaceEmbedder the detected faces are embedded by, None skips the embeddings.
+            optimizedInference: run the detector in the optimized inference mode, see inference_context.
+    Yields:
+        (index, values) tuples as images are evaluated, values holds the new columns for the row with that index label
     '''
-    results = []
-    for i, row in images.iterrows():
-        imageName = row["NewImage"]
-        imagePath = os.path.join(inputdir, imageName)
-        img = Image.open(imagePath)
-        outFile = f'detected_face_{imageName}'
-        # Get cropped and prewhitened image tensor
-        savepath = os.path.join(outputDir, outFile)
-        img_cropped = mtcnn(img, save_path=savepath)
-        boxes, probs, landmarks = mtcnn.detect(img, landmarks=True)
-
-        box = []
-        x = None
-        y = None
-        width = None
-        height = None
-        if(boxes is not None):
-            _box = boxes[0]
-            x = _box[0]
-            y = _box[1]
-            width = _box[2] - x
-            height = _box[3] - y
-
-        detected = x is not None and y is not None and width is not None and height is not None
-
-        row['FaceDetected'] = detected
-        row['X'] = x
-        row['Y'] = y
-        row['Width'] = width
-        row['Height'] = height
-        row['confidence'] = probs[0]
-        row['dtImageName'] = outFile
-        landmark = None
-        if landmarks is not None:
-            landmark = landmarks[0]
-            if landmark is not None:
-                landmark = landmarks.tolist()
-
-        row['landmarks'] = landmark
-        results.append(row)
-    return results
+    if shardReader is not None and len(shardReader) > 0:
+        # read the shards front to back instead of seeking around them
+        names = images["NewImage"].tolist()
+        order = sorted(range(len(names)), key=lambda n: shardReader.sort_key(names[n])
+                       if names[n] in shardReader else ('', n))
+        images = images.iloc[order]
+
+    metrics = metrics or StageMetrics("eval", "OFF")
+    samples = load_eval_images(images, inputdir, shardReader, loaderWorkers, prefetchDepth, decodedCache)
+    batches = iter_eval_batches(samples, batchSize)
+    while True:
+        # time spent waiting for the loader, high when decoding can't keep up with the detector
+        with metrics.latency("load_wait"):
+            batch = next(batches, None)
+        if batch is None:
+            break
+
+        detectStart = time.perf_counter()
+        with inference_context(optimizedInference):
+            batchBoxes, batchProbs, batchLandmarks = mtcnn.detect(
+                [img for _, _, img in batch], landmarks=True)
+        if metrics.histogramsEnabled:
+            # the batch is detected in one call, every image is recorded with its share of the batch time
+            detectSeconds = (time.perf_counter() - detectStart) / len(batch)
+            for _ in batch:
+                metrics.observe("detect", detectSeconds)
+        metrics.count("images_evaluated", len(batch))
+
+        for (i, imageName, img), boxes, probs, landmarks in zip(batch, batchBoxes, batchProbs, batchLandmarks):
+            outFile = crop_file_name(imageName, cropFormat) if cropWriter is not None else None
+
+            x = None
+            y = None
+            width = None
+            height = None
+            if(boxes is not None):
+                # boxes are ordered by the detector's selection (largest first), the face mtcnn(img) would crop
+                _box = boxes[0]
+                x = _box[0]
+                y = _box[1]
+                width = _box[2] - x
+                height = _box[3] - y
+
+                # crop the detected face from the same detection result, encoding and writing it happens on the writer pool
+                if cropWriter is not None:
+                    crop = facenet.extract_face(img, _box, mtcnn.image_size, mtcnn.margin)
+                    cropWriter.submit(save_crop, crop, os.path.join(outputDir, outFile), cropFormat, compressLevel)
+
+            detected = x is not None and y is not None and width is not None and height is not None
+            if detected:
+                metrics.count("faces_detected")
+            if embedder is not None:
+                embedder.add(imageName, img, _box if detected else None)
+
+            landmark = None
+            if landmarks is not None:
+                landmark = landmarks[0]
+                if landmark is not None:
+                    landmark = landmark.tolist()
+
+            yield i, {'FaceDetected': detected,
+                      'X': x,
+                      'Y': y,
+                      'Width': width,
+                      'Height': height,
+                      'confidence': probs[0],
+                      'dtImageName': outFile,
+                      'landmarks': landmark}
+
+    if embedder is not None:
+        embedder.flush()
+
+def get_mpi_comm():
+    '''
+    Defines method that returns the MPI world communicator, mpi4py is imported here as only the MPI mode needs it.
+    An error on one rank would leave the other ranks waiting for its results, with more than one rank
+    an uncaught error aborts all of them instead, like running under python -m mpi4py.
+    '''
+    from mpi4py import MPI
+
+    comm = MPI.COMM_WORLD
+    if comm.Get_size() > 1:
+        previousHook = sys.excepthook
+
+        def abort_ranks(*excInfo):
+            previousHook(*excInfo)
+            sys.stderr.flush()
+            comm.Abort(1)
+        sys.excepthook = abort_ranks
+    return comm
+
+def rank_images(images, rank, rankCount):
+    '''
+    Defines method that returns the contiguous block of {images} evaluated by MPI rank {rank} of {rankCount},
+    the blocks of all ranks in rank order make up {images}.
+    '''
+    return images.iloc[len(images) * rank // rankCount:len(images) * (rank + 1) // rankCount]
+
+def gather_eval_rows(comm, rows, valCount):
+    '''
+    Defines method that gathers the eval result rows of every rank onto rank 0, in the order a single process
+    writes them: the validation rows of ranks 0 to n-1, then their test rows.
+
+    Args:
+        comm: MPI communicator
+        rows: list of (position, values) tuples of this rank, its validation rows first. values holds
+              the EVAL_COLUMNS values of the row as a tuple, which pickles much smaller than a dict
+        valCount: number of validation rows in {rows}
+    Returns:
+        on rank 0 the rows of all ranks and the list of (rank, start, end, outputRow) blocks of their embedding rows
+        placed at outputRow of the output table, on the other ranks None
+    '''
+    counts = comm.gather((len(rows), valCount), root=0)
+    gathered = comm.gather(rows, root=0)
+    if comm.Get_rank() != 0:
+        return None
+
+    ordered = [rankRows[:valCount] for rankRows, (_, valCount) in zip(gathered, counts)]
+    ordered += [rankRows[valCount:] for rankRows, (_, valCount) in zip(gathered, counts)]
+
+    # embedding rows of every rank, its validation rows go to the first part of the table and its test rows to the second
+    blocks = []
+    outputRow = 0
+    for rank, (rowCount, valCount) in enumerate(counts):
+        blocks.append((rank, 0, valCount, outputRow))
+        outputRow += valCount
+    for rank, (rowCount, valCount) in enumerate(counts):
+        blocks.append((rank, valCount, rowCount, outputRow))
+        outputRow += rowCount - valCount
+    return list(chain.from_iterable(ordered)), blocks
+
+def gather_embeddings(comm, embeddings, blocks=None, output=None):
+    '''
+    Defines method that sends the embeddings of every rank to rank 0, which writes them into {output}
+    at the rows given by the {blocks} returned by gather_eval_rows.
+    '''
+    if comm.Get_rank() != 0:
+        comm.Send(np.ascontiguousarray(embeddings, dtype=np.float32), dest=0)
+        return
+
+    received = {0: embeddings}
+    for rank in range(1, comm.Get_size()):
+        rowCount = max([end for blockRank, _, end, _ in blocks if blockRank == rank] + [0])
+        received[rank] = np.empty((rowCount, embeddings.shape[1]), dtype=np.float32)
+        comm.Recv(received[rank], source=rank)
+    for rank, start, end, outputRow in blocks:
+        output[outputRow:outputRow + end - start] = received[rank][start:end]
 
 def main():
     ''' Main method '''
     args = parse_args()
-    
-    print(f'parse args: {args}')
+    trainingConfig = args.training_config
+    jsonconfig = json.loads(trainingConfig)
+
+    # LogLevel DEBUG adds the per step details. MetricsLevel INFO records stage timers and counters,
+    # DEBUG adds per-image latency histograms and OFF disables them, they are written to {uuid}.stage_metrics.json
+    configure_logging(jsonconfig.get('LogLevel', 'INFO'))
+    metrics = StageMetrics("train", jsonconfig.get('MetricsLevel', 'INFO'))
+    stageStart = time.perf_counter()
+
+    logger.info(f'parse args: {args}')
 
     inputdir = os.path.join(args.data_dir)
     outputDir = os.path.join("outputs")
     inputTableDir = os.path.join(inputdir, 'AP_Metadata')
     resultMetadataFolder = os.path.join(outputDir, 'AP_Metadata')
-    print(args.training_config)
-    trainingConfig = args.training_config
-    print(type(trainingConfig))
-    jsonconfig = json.loads(trainingConfig)
 
-    print(f'jsonConfig: {jsonconfig}')
-    print(
+    logger.info(f'jsonConfig: {jsonconfig}')
+    logger.info(
         f'Starting training with inputdir:{inputdir}, writing results to {outputDir} and training config: {trainingConfig}.')
-    print(
+    logger.info(
         f'Will read AP Metadata table from {inputTableDir} and write a new one to {resultMetadataFolder}')
     tableFile, uuid, schemaFile = read_input_meta_table(inputTableDir)
 
     if(tableFile == None):
         raise Exception("Did not find table file " + tableFile)
     sampleStr = jsonconfig['SampleRate']
-    print(f'sampleStr {sampleStr}')
+    logger.info(f'sampleStr {sampleStr}')
 
     logSampleRage = float(sampleStr)
-    # read the table file that contains metadata for each overlay we will work with
-    create_dir_if_not_Exist(resultMetadataFolder)
+
+    # the output table is written in chunks of this many rows as images are evaluated, optionally gzip compressed.
+    # a gzip table is named .metadata.csv.gz, Aggregate and this script read it, AP uploads need plain csv
+    outputChunkRows = int(jsonconfig.get('OutputChunkRows', 10000))
+    outputCompression = jsonconfig.get('OutputCompression') or None
+
+    # number of images of the same resolution passed to the detector at once
+    evalBatchSize = int(jsonconfig.get('EvalBatchSize', 16))
+
+    # images are decoded by background processes, each decoding up to PrefetchDepth images ahead of the detector
+    loaderWorkers = int(jsonconfig.get('LoaderWorkers', 2))
+    prefetchDepth = int(jsonconfig.get('PrefetchDepth', 4))
+
+    # metrics are logged in batches of MetricsFlushSize values, LocalRunLog logs to a local file instead of the AzureML run
+    metricsFlushSize = int(jsonconfig.get('MetricsFlushSize', 250))
+    localRunLog = jsonconfig.get('LocalRunLog') or None
+
+    # face crops are encoded and written by a bounded pool of background writers, SaveCrops false skips them
+    saveCrops = str(jsonconfig.get('SaveCrops', 'true')).lower() == 'true'
+    cropFormat = jsonconfig.get('CropFormat', 'PNG')
+    compressLevel = int(jsonconfig.get('CropCompressLevel', 6))
+    cropWriterThreads = int(jsonconfig.get('CropWriterThreads', 4))
+    cropWriterQueue = int(jsonconfig.get('CropWriterQueue', 64))
+
+    # DecodedCacheDir keeps the decoded eval images in a memory-mapped file per dataset, reruns and sweeps
+    # over the same dataset read the pixels from it instead of decoding them again. Empty decodes every run
+    decodedCacheDir = jsonconfig.get('DecodedCacheDir') or None
+
+    # Embeddings true runs the detected faces through InceptionResnetV1 in batches of EmbeddingBatchSize,
+    # the embeddings are written to {uuid}.embeddings.npy with one row per output table row.
+    # Image pairs more similar than DuplicateSimilarity are written to {uuid}.similar_pairs.csv, empty skips them
+    computeEmbeddings = str(jsonconfig.get('Embeddings', 'false')).lower() == 'true'
+    embeddingBatchSize = int(jsonconfig.get('EmbeddingBatchSize', 32))
+    embeddingMargin = int(jsonconfig.get('EmbeddingMargin', 0))
+    duplicateSimilarity = jsonconfig.get('DuplicateSimilarity') or None
+
+    # InferenceMode optimized runs the detector and embedder as TorchScript traces in torch.inference_mode
+    # on InferenceThreads threads (0 keeps the torch default), QuantizeEmbedder true also quantizes the embedder
+    # to int8. eager runs them as they are, see benchmarks/InferenceReport.py for the accuracy and latency of both
+    inferenceMode = jsonconfig.get('InferenceMode', 'eager').lower()
+    if inferenceMode not in ('eager', 'optimized'):
+        raise ValueError(f"Unknown inference mode {inferenceMode}, expected eager or optimized")
+    optimizedInference = inferenceMode == 'optimized'
+    inferenceThreads = int(jsonconfig.get('InferenceThreads', 0))
+    quantizeEmbedder = str(jsonconfig.get('QuantizeEmbedder', 'false')).lower() == 'true'
+
+    # DistributedBackend mpi splits the validation and test images across the MPI ranks, eg launched with
+    # mpirun -n 4, rank 0 runs the training, gathers the rows of all ranks and writes the output table.
+    # empty runs everything in this process. Estimator.GetEstimator sets it when more than one process is requested
+    distributedBackend = jsonconfig.get('DistributedBackend') or None
+    if distributedBackend not in (None, 'mpi'):
+        raise ValueError(f"Unknown distributed backend {distributedBackend}, expected mpi or empty")
+    comm = get_mpi_comm() if distributedBackend == 'mpi' else None
+    rank, rankCount = (comm.Get_rank(), comm.Get_size()) if comm is not None else (0, 1)
                
     colDefs = [FLOATNULLABLE_SCHEMA_TEMPLATE.format('FaceDetected'),
                FLOATNULLABLE_SCHEMA_TEMPLATE.format('Confidence'),
@@ -139,46 +651,160 @@ def main():
                FLOATNULLABLE_SCHEMA_TEMPLATE.format('Width'),
                FLOATNULLABLE_SCHEMA_TEMPLATE.format('Height')]
 
-    write_output_schema(resultMetadataFolder, uuid, schemaFile, colDefs)
-    df = pd.read_csv(tableFile, sep=',', header='infer')
+    # only rank 0 writes to AP_Metadata, it creates the folder so the ranks do not race on it
+    if rank == 0:
+        create_dir_if_not_Exist(resultMetadataFolder)
+        write_output_schema(resultMetadataFolder, uuid, schemaFile, colDefs)
+    # read the table file that contains metadata for each overlay we will work with
+    with metrics.timer("load_table"):
+        df = load_meta_table(tableFile, schemaFile, ['NewImage', 'IsTrainData', 'IsValData', 'IsTestData'])
 
-    # grab the current columns and create an empty data frame
-    # new data frame will contain the propagated metadata and new information about
-    # the created image.
-    cols = df.columns.tolist()
-    emptyDf = pd.DataFrame(columns=cols)
+    # the new table will contain the propagated metadata and new information about
+    # the detected face.
+    tableBuilder = ResultTableBuilder(df, EVAL_COLUMNS)
 
     # filter to images used within training
-    trainImages = df.loc[df["IsTrainData"] == True]
+    # the split columns are nullable, rows without a value are not in the split
+    isTrain = df["IsTrainData"].fillna(False).astype(bool)
+    isVal = df["IsValData"].fillna(False).astype(bool)
+    isTest = df["IsTestData"].fillna(False).astype(bool)
+    trainImages = df.loc[isTrain]
 
     # filter to all images that are train Data and Validation
-    valImages = df.loc[(df["IsTrainData"] == True) & (df["IsValData"] == True)]
+    valImages = df.loc[isTrain & isVal]
 
     # filter to all test images
-    testImages = df.loc[df["IsTestData"] == True]
+    testImages = df.loc[isTest]
 
     # Run training and model generation
-    run_training(trainImages, inputdir, logSampleRage)
+    if rank == 0:
+        with metrics.timer("training"):
+            run_training(trainImages, inputdir, logSampleRage, get_run_context(localRunLog), metricsFlushSize)
+
+    # with MPI every rank evaluates its block of the validation images and of the test images
+    if comm is not None:
+        valImages = rank_images(valImages, rank, rankCount)
+        testImages = rank_images(testImages, rank, rankCount)
+        logger.info(f'rank {rank} of {rankCount} evaluating {len(valImages)} validation and {len(testImages)} test images')
 
     # instantiate MTCCN, using pretrained models here
     # you would consume model generated by stage above here.
-    mtcnn = MTCNN(image_size=512, margin=512, post_process=False)
+    mtcnn = facenet.MTCNN(image_size=512, margin=512, post_process=False)
+    if optimizedInference:
+        configure_inference_threads(inferenceThreads)
+        optimize_detector(mtcnn)
     
-    rez = []
+    # images prepared with the tar output format are read from their shards
+    shardReader = ImageShardReader(inputdir)
+    logger.info(f'found {len(shardReader)} images in tar shards')
+
+    # decode the validation and test images once, both eval passes then read them from the cache.
+    # every MPI rank keeps its own cache of its images
+    decodedCache = None
+    if decodedCacheDir is not None:
+        os.makedirs(decodedCacheDir, exist_ok=True)
+        cacheName = uuid if comm is None else f'{uuid}.rank{rank:03d}of{rankCount:03d}'
+        decodedCache = DecodedImageCache(os.path.join(decodedCacheDir, cacheName))
+        with metrics.timer("decode_cache"):
+            added = fill_decoded_cache(pd.concat([valImages, testImages]), inputdir, decodedCache, shardReader,
+                                       loaderWorkers, prefetchDepth)
+        metrics.count("images_decoded", added)
+        logger.info(f'decoded {added} images into {decodedCache.pixelsPath}, {len(decodedCache)} images cached')
 
-    # run evaluation on validation images
-    rez.append(run_eval(valImages, inputdir, mtcnn, outputDir))
+    cropWriter = BackgroundWriterPool(cropWriterThreads, cropWriterQueue) if saveCrops else None
 
-    # run evaluation on test images
-    rez.append(run_eval(testImages, inputdir, mtcnn, outputDir))
+    # the embeddings are written straight to the output file, MPI ranks keep theirs in memory until they are gathered
+    embedder = None
+    if computeEmbeddings:
+        embeddingsPath = os.path.join(outputDir, f'{uuid}.embeddings.npy')
+        rowCount = len(valImages) + len(testImages)
+        if comm is None:
+            embeddings = create_embedding_matrix(embeddingsPath, rowCount, EMBEDDING_DIMENSION)
+        else:
+            embeddings = np.full((rowCount, EMBEDDING_DIMENSION), np.nan, dtype=np.float32)
+        embeddingModel = load_face_embedder(os.path.join("pretrainedModel", "vggface2.pt"))
+        if optimizedInference:
+            embeddingModel = optimize_embedder(embeddingModel, quantizeEmbedder)
+        embedder = FaceEmbedder(embeddingModel, embeddings, embeddingBatchSize, embeddingMargin, metrics,
+                                optimizedInference)
 
-    # merge the results and add them into a new data frame table
-    for num, row in enumerate(reduce(list.__add__, rez), start=0):
-        emptyDf = emptyDf.append(row, ignore_index=True, sort=False)
+    # run evaluation on validation images, then on test images
+    rez = chain(run_eval(valImages, inputdir, mtcnn, outputDir, shardReader, evalBatchSize, loaderWorkers, prefetchDepth,
+                         cropWriter, cropFormat, compressLevel, metrics, decodedCache, embedder, optimizedInference),
+                run_eval(testImages, inputdir, mtcnn, outputDir, shardReader, evalBatchSize, loaderWorkers, prefetchDepth,
+                         cropWriter, cropFormat, compressLevel, metrics, decodedCache, embedder, optimizedInference))
+    evalStart = time.perf_counter()
+    rows = ((df.index.get_loc(index), values) for index, values in rez)
+
+    if comm is not None:
+        # evaluate the images of this rank, then gather the rows of all ranks on rank 0
+        evalColumns = [column for column, _ in EVAL_COLUMNS]
+        rankRows = [(position, tuple(values[column] for column in evalColumns)) for position, values in rows]
+        metrics.add_time("eval_rank", time.perf_counter() - evalStart)
+        with metrics.timer("gather"):
+            gathered = gather_eval_rows(comm, rankRows, len(valImages))
+        rows = []
+        if rank == 0:
+            rows = ((position, dict(zip(evalColumns, values))) for position, values in gathered[0])
 
     csvPath = os.path.join(resultMetadataFolder,
                            f'{uuid}.outputTable.metadata.csv')
-    emptyDf.to_csv(csvPath, index=False)
+
+    # merge the results and add them into a new data frame table, written out in chunks as they complete
+    outputPositions = array('q')
+    if rank == 0:
+        with StreamingTableWriter(csvPath, outputCompression) as tableWriter:
+            for position, values in rows:
+                tableBuilder.add(position, **values)
+                outputPositions.append(position)
+                if len(tableBuilder) >= outputChunkRows:
+                    tableWriter.write(tableBuilder.drain())
+
+            tableWriter.write(tableBuilder.drain())
+        metrics.count("rows_written", tableWriter.rowsWritten)
+    shardReader.close()
+    if decodedCache is not None:
+        decodedCache.close()
+    metrics.add_time("eval", time.perf_counter() - evalStart)
+
+    if embedder is not None:
+        if comm is not None:
+            # rank 0 writes the embeddings of all ranks at the rows of their images in the output table
+            localEmbeddings = embeddings
+            embeddings = create_embedding_matrix(embeddingsPath, len(outputPositions), EMBEDDING_DIMENSION) if rank == 0 else None
+            with metrics.timer("gather"):
+                gather_embeddings(comm, localEmbeddings, gathered[1] if rank == 0 else None, embeddings)
+        if rank == 0:
+            embeddings.flush()
+            logger.info(f'wrote face embeddings of {len(outputPositions)} rows to {embeddingsPath}')
+            if duplicateSimilarity is not None:
+                with metrics.timer("similar_pairs"):
+                    pairCount = write_similar_pairs(embeddings, df["NewImage"].values[np.frombuffer(outputPositions, dtype=np.int64)],
+                                                    float(duplicateSimilarity),
+                                                    os.path.join(outputDir, f'{uuid}.similar_pairs.csv'))
+                metrics.count("similar_pairs", pairCount)
+
+    # wait for the outstanding crops, a failed write fails the run once the table is written
+    if cropWriter is not None:
+        cropWriter.close()
+        metrics.count("crops_written", cropWriter.written)
+        logger.info(f'wrote {cropWriter.written} face crops')
+
+    metrics.add_time("total", time.perf_counter() - stageStart)
+    if comm is not None:
+        # counters and histograms of all ranks are added up, the timers of every rank are kept apart as they overlap
+        snapshots = comm.gather(metrics.snapshot(), root=0)
+        if rank != 0:
+            return
+        rankTimers = []
+        for snapshot in snapshots:
+            if snapshot is not None:
+                rankTimers.append(snapshot["timers"])
+        for snapshot in snapshots[1:]:
+            if snapshot is not None:
+                metrics.merge(dict(snapshot, timers={}))
+        metrics.set_detail("ranks", rankTimers)
+    metrics.write(os.path.join(resultMetadataFolder, f'{uuid}.stage_metrics.json'))
 
 if __name__ == '__main__':
     main()